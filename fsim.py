@@ -6,22 +6,62 @@
 
 import time
 import sys, os
+import glob
+import hashlib
+import collections
 
 import numpy
 from direct.showbase.ShowBase import ShowBase
 from direct.task import Task
 from panda3d.core import GeoMipTerrain, PNMImage, Vec3
 from panda3d.core import AmbientLight, DirectionalLight
-from panda3d.core import TextNode, NodePath, CardMaker, TextFont
-from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import TextNode, NodePath, CardMaker, TextFont, Texture
+from panda3d.core import Shader, Geom, GeomNode, GeomTriangles, GeomVertexData, GeomVertexFormat, GeomVertexArrayFormat
+from panda3d.core import GeomVertexReader, GeomVertexWriter, InternalName, BoundingSphere
 from direct.stdpy import threading
 
 import p3dprims as pp
+import objgrid as og
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+import hfr
+import p3dpager
 
 
 VERSION='v20211013IST1703'
 
 
+# The shaders of the batched object labels (refer to build_labels_cell). Each vertex is at its label's anchor,
+# and is moved by its offset within the label in view space, so that all the labels of a cell face the camera,
+# while being a single geom.
+LABEL_VSHADER = """#version 120
+uniform mat4 p3d_ModelViewMatrix;
+uniform mat4 p3d_ProjectionMatrix;
+attribute vec4 p3d_Vertex;
+attribute vec4 p3d_Color;
+attribute vec2 p3d_MultiTexCoord0;
+attribute vec3 offset;
+varying vec2 texcoord;
+varying vec4 color;
+void main() {
+    vec4 pos = p3d_ModelViewMatrix * p3d_Vertex;
+    pos.xyz += vec3(offset.x, offset.z, -offset.y);
+    gl_Position = p3d_ProjectionMatrix * pos;
+    texcoord = p3d_MultiTexCoord0;
+    color = p3d_Color;
+}
+"""
+
+LABEL_FSHADER = """#version 120
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+varying vec2 texcoord;
+varying vec4 color;
+void main() {
+    gl_FragColor = color * p3d_ColorScale * vec4(1, 1, 1, texture2D(p3d_Texture0, texcoord).a);
+}
+"""
+
+
 class FSim(ShowBase):
 
     def __init__(self, cfg):
@@ -36,10 +76,20 @@ class FSim(ShowBase):
         self.crot = Vec3(0, 0, 0)
         self.gndWidth = 4097
         self.gndHeight = 4097
+        self.terrainSz = 100
+        # The shared cube geometry, and the models (loaded in the background) by path.
+        # The world update thread uses its own copy of the cube, when building the cell batches.
+        self.cubeProto = NodePath(pp.create_cube("Cube"))
+        self.cubeProtoWU = NodePath(pp.create_cube("Cube"))
+        self.modelProtos = {}
+        self.modelsPending = {}
         # Setup the world
         self.setup_mc()
         self.setup_hud()
-        self.create_terrain(cfg['sTerrainFile'])
+        if cfg['bTerrainPaged']:
+            self.create_terrain_paged(cfg['sTerrainFile'])
+        else:
+            self.create_terrain(cfg['sTerrainFile'])
         self.create_objects(cfg['sTerrainFile'])
         self.init_with_world()
 
@@ -48,14 +98,16 @@ class FSim(ShowBase):
         """
         Adjust things based on loaded terrain and initialise.
         """
-        hf=self.terrain.heightfield()
         if cfg['bTopView']:
-            self.cDefPos = Vec3(hf.getXSize()/2, hf.getYSize()/2, hf.getXSize()*10)
+            self.cDefPos = Vec3(self.gndWidth/2, self.gndHeight/2, self.gndWidth*10)
             self.cDefFace = Vec3(0, -90, 0)
-        self.uoPos = Vec3(self.cDefPos)
         self.set_mcc(self.cDefPos, self.cDefFace)
         self.updateCPos = self.camera.getPos()
-        self.updateDelta = numpy.average((hf.getXSize(), hf.getYSize()))*0.05
+        # The lod is managed per tile, in paged mode
+        if self.pager != None:
+            self.updateDelta = (self.pager.iTileSize-1)*0.05
+        else:
+            self.updateDelta = numpy.average((self.gndWidth, self.gndHeight))*0.05
 
 
     def setup_mc(self):
@@ -87,12 +139,13 @@ class FSim(ShowBase):
             current position and orientation,
             translation and rotation actions that are being applied,
             the height above ground,
-            distance moved relative to last world update.
+            distance moved relative to last world update,
+            the nearest airfield/object and its distance.
         """
         self.hud = {}
         self.hud['frame'] = CardMaker("HUD")
         self.hud['frame'].setColor(0.1,0.2,0.1,0.2)
-        self.hud['frame'].setFrame(-0.94,0.94,0.74,0.98)
+        self.hud['frame'].setFrame(-0.94,0.94,0.64,0.98)
         self.hud['frameNP'] = self.render2d.attachNewNode(self.hud['frame'].generate())
         self.hud['frameNP'].setTransparency(True)
         fwFont = loader.loadFont("cmtt12.egg")
@@ -106,6 +159,8 @@ class FSim(ShowBase):
                 # Status
                 [ "S1",  (-0.1, 0.9), 0.04 ],
                 [ "S2",  (-0.1, 0.8), 0.04 ],
+                # Navigation
+                [ "Nav", (-0.9, 0.7), 0.04 ],
             ]
         for o in lO:
             self.hud[o[0]] = TextNode(o[0])
@@ -157,9 +212,59 @@ class FSim(ShowBase):
         return hf
 
 
+    def _load_hfr(self, hfrFName):
+        """
+        Memory map the given hfr heightfield file, and build the PNMImage needed by GeoMipTerrain
+        from it, through a single buffer transfer into a Texture ram image (ie without png decoding).
+        The memory mapped heights are also used for looking up the terrain height.
+        """
+        dHdr, self.hfRaw = hfr.load(hfrFName)
+        self.hfRawScale = dHdr['scale']
+        print("DBUG:Terrain:HFR:{}:{}x{}:Geo:{},{}:{},{}".format(hfrFName, dHdr['xw'], dHdr['yh'], dHdr['slon'], dHdr['slat'], dHdr['elon'], dHdr['elat']))
+        if dHdr['dtype'] == 1:
+            hf16 = self.hfRaw
+        else:
+            hf16 = numpy.round(numpy.clip(self.hfRaw, 0, 1)*65535).astype(numpy.uint16)
+        return self._numpy2pnm(hf16)
+
+
+    def _numpy2pnm(self, rImg):
+        """
+        Convert the passed numpy image ([y, x] gray or [y, x, 3] RGB, as uint8 or uint16) into a PNMImage,
+        through a single buffer transfer into a Texture ram image.
+        """
+        tex = Texture("N2P")
+        cType = Texture.TUnsignedShort if rImg.dtype == numpy.uint16 else Texture.TUnsignedByte
+        if len(rImg.shape) == 2:
+            tex.setup2dTexture(rImg.shape[1], rImg.shape[0], cType, Texture.FLuminance)
+        else:
+            tex.setup2dTexture(rImg.shape[1], rImg.shape[0], cType, Texture.FRgb)
+            # Texture ram images are BGR
+            rImg = rImg[:,:,::-1]
+        # Texture ram images are bottom row first
+        tex.setRamImage(numpy.ascontiguousarray(rImg[::-1]))
+        pnm = PNMImage()
+        tex.store(pnm)
+        return pnm
+
+
+    def _pnm2gray(self, pnm):
+        """
+        Get the gray values (0.0 to 1.0, as got by PNMImage.getGray, which is the blue component for color images)
+        of the passed PNMImage, as a [y, x] float32 numpy array, through a single buffer transfer from a Texture ram image.
+        """
+        tex = Texture("P2N")
+        tex.load(pnm)
+        dtype = numpy.uint16 if tex.getComponentType() == Texture.TUnsignedShort else numpy.uint8
+        rImg = numpy.frombuffer(tex.getRamImage(), dtype=dtype)
+        rImg = rImg.reshape(tex.getYSize(), tex.getXSize(), tex.getNumComponents())[::-1]
+        # Both gray and BGR(A) have the wanted component first
+        return rImg[:,:,0]*numpy.float32(1/pnm.getMaxval())
+
+
     def _create_colormap(self, hf):
         """
-        Color the passed terrain based on height.
+        Color the passed terrain based on height, and return the colormap as a [y, x, 3] uint8 numpy array.
             With Below SeaLevel data (maybe)
                 0.0 - 0.1 : SeaLevel and Below
                 0.1 - 0.6 : ground and hills plus
@@ -169,121 +274,295 @@ class FSim(ShowBase):
                 0.0001 - 0.5 : Ground and Hills plus
                 0.5   -  1.0 : Mountains etal
         """
-        cm = PNMImage(hf.getXSize(), hf.getYSize())
-        print("DBUG:Terrain:CM:{}x{}".format(cm.getXSize(), cm.getYSize()))
-        hfMin, hfMax = 256, 0
-        for x in range(hf.getXSize()):
-            for y in range(hf.getYSize()):
-                hfv = hf.getGray(x, y)
-                hfMin = min(hfMin, hfv)
-                hfMax = max(hfMax, hfv)
-                if self.cfg['bCMGrayShades']:
-                    cm.setXel(x, y, hfv)
+        print("DBUG:Terrain:CM:{}x{}".format(hf.getXSize(), hf.getYSize()))
+        # Like getGray, the heights are float32, with the math on them in float64
+        hfv = self._pnm2gray(hf).astype(numpy.float64)
+        hfMin, hfMax = hfv.min(), hfv.max()
+        cm = numpy.zeros(hfv.shape+(3,), dtype=numpy.float32)
+        if self.cfg['bCMGrayShades']:
+            cm[:] = hfv[:,:,numpy.newaxis]
+        else:
+            # Each band is [ upTo, channel(s) to set, base, range ], with heights beyond the last band's upTo using it
+            if self.cfg['bHFNoBelowSeaLevel']:
+                lBands = [ [ 0.000001, 2, 0.0, 0.000001 ], [ 0.25, 1, 0.0, 0.25 ], [ 0.75, 0, 0.25, 0.50 ], [ None, slice(0,3), 0.75, 0.25 ] ]
+            else:
+                lBands = [ [ 0.1, 2, 0.0, 0.1 ], [ 0.60, 1, 0.1, 0.50 ], [ None, 0, 0.6, 0.40 ] ]
+            mDone = numpy.zeros(hfv.shape, dtype=bool)
+            for upTo, iC, base, rng in lBands:
+                if upTo == None:
+                    mBand = ~mDone
                 else:
-                    if self.cfg['bHFNoBelowSeaLevel']:
-                        if hfv < 0.000001:
-                            cm.setBlue(x, y, (0.2+0.8*(hfv/0.000001)))
-                        elif hfv < 0.25:
-                            cm.setGreen(x, y, (0.2+0.8*(hfv/0.25)))
-                        elif hfv < 0.75:
-                            cm.setRed(x, y, (0.2+0.8*((hfv-0.25)/0.50)))
-                        else:
-                            cm.setXel(x, y, (0.2+0.8*((hfv-0.75)/0.25)))
-                    else:
-                        if hfv < 0.1:
-                            cm.setBlue(x, y, (0.2+0.8*(hfv/0.1)))
-                        elif hfv < 0.60:
-                            cm.setGreen(x, y, (0.2+0.8*((hfv-0.1)/0.50)))
-                        else:
-                            cm.setRed(x, y, (0.2+0.8*((hfv-0.6)/0.40)))
+                    mBand = (hfv < upTo) & ~mDone
+                    mDone |= mBand
+                v = 0.2+0.8*((hfv[mBand]-base)/rng)
+                cm[mBand, iC] = v[:,numpy.newaxis] if type(iC) == slice else v
         print("DBUG:Terrain:CM:HFMinMax:{},{}".format(hfMin, hfMax))
-        return cm
+        # Same conversion as PNMImage does for float values
+        cm = numpy.clip(cm, 0, 1)*numpy.float32(255)+numpy.float32(0.5)
+        return cm.astype(numpy.uint8)
+
+
+    def _cmcache_fname(self, hfFile, hfSrcFName):
+        """
+        Get the colormap cache file name, which is keyed by the content hash of the heightfield file (hfSrcFName)
+        and the colormap options, as <hfFile>.cm.<HFHash>.<Opts>.npy
+        """
+        h = hashlib.sha1()
+        f = open(hfSrcFName, "rb")
+        while True:
+            data = f.read(1<<20)
+            if len(data) == 0:
+                break
+            h.update(data)
+        f.close()
+        sOpts = "CM1G{}N{}".format(int(self.cfg['bCMGrayShades']), int(self.cfg['bHFNoBelowSeaLevel']))
+        return "{}.cm.{}.{}.npy".format(hfFile, h.hexdigest(), sOpts)
+
+
+    def _save_cmcache(self, cmCacheFName, cmArr):
+        """
+        Save the colormap cache file (done in a background thread, once the first frame is up).
+        Colormap cache files of older heightfield contents are removed, while the ones for the
+        other colormap options of the same heightfield are retained.
+        """
+        tmpFName = "{}.tmp".format(cmCacheFName)
+        f = open(tmpFName, "wb")
+        numpy.save(f, cmArr)
+        f.close()
+        os.replace(tmpFName, cmCacheFName)
+        sBase, sHash, sOpts = cmCacheFName[:-len(".npy")].rsplit(".", 2)
+        for sOld in glob.glob("{}.*.npy".format(sBase)):
+            if sOld[len(sBase)+1:].split(".")[0] != sHash:
+                os.remove(sOld)
+        print("DBUG:Terrain:CMCache:Saved:{}".format(cmCacheFName))
+
+
+    def _new_terrain(self, name, hf, cm, focus, bBorderStitching=False):
+        """
+        Create a GeoMipTerrain (not attached to the scene graph) with the passed heightfield and colormap.
+        Its lod is based on the passed focal point node (refer to world_updater_tf), rather than the camera.
+        With border stitching, the borders are kept at full detail, so that neighbouring terrains meet without seams.
+        """
+        terrain = GeoMipTerrain(name)
+        terrain.setMinLevel(self.cfg['iLODMinLevel'])
+        terrain.setHeightfield(hf)
+        terrain.setColorMap(cm)
+        blockSize = int((hf.getXSize()-1)/8)
+        lodFar = blockSize*4
+        lodNear = max(64,lodFar/4)
+        print("DBUG:Terrain:{}:LOD:BlockSize:{}:Far:{}:Near:{}".format(name, blockSize, lodFar, lodNear))
+        terrain.setBlockSize(blockSize)
+        terrain.setNear(lodNear)
+        terrain.setFar(lodFar)
+        terrain.setFocalPoint(focus)
+        terrain.setAutoFlatten(self.cfg['LODAFMode'])
+        terrain.setBruteforce(self.cfg['bLODBruteForce'])
+        terrain.setBorderStitching(bBorderStitching)
+        tRoot = terrain.getRoot()
+        #tRoot.setSx(4)
+        #tRoot.setSy(4)
+        tRoot.setSz(self.terrainSz)
+        terrain.generate()
+        return terrain
 
 
     def create_terrain(self, hfFile, bCMGrayShades=False, bHFNoBelowSeaLevel=True):
         """
         Create a terrain based on the passed heightfield and colormap.
+
+        A helper generated <hfFile>.cm.png (say from hkvc_imgutils p3dterrain/mapto) always wins, as it
+        could be colored from a reference image. bCMGrayShades and bHFNoBelowSeaLevel only apply to the
+        colormap generated here (and its cache), when there is no such cm.png.
         """
         self.cfg['bCMGrayShades'] = bCMGrayShades
         self.cfg['bHFNoBelowSeaLevel'] = bHFNoBelowSeaLevel
-        self.terrain = GeoMipTerrain("Gnd")
-        self.terrain.setMinLevel(self.cfg['iLODMinLevel'])
         # The Heightfield
         cmFName = None
-        cmFNameSave = None
+        hfSrcFName = None
+        self.hfRaw = None
+        self.pager = None
+        self.cmCachePending = None
         if hfFile == None:
             hf = self._create_heightfield()
         else:
             hfFName = "{}.hf.png".format(hfFile)
+            hfrFName = "{}.hf.hfr".format(hfFile)
             cmFName = "{}.cm.png".format(hfFile)
+            if os.path.exists(hfrFName):
+                hf = self._load_hfr(hfrFName)
+                hfSrcFName = hfrFName
+            else:
+                hf = PNMImage(hfFName)
+                hfSrcFName = hfFName
+            self.gndWidth, self.gndHeight = hf.getXSize(), hf.getYSize()
+            # A helper cm.png wins, but let the user know if it could be stale
             if not os.path.exists(cmFName):
-                cmFNameSave = cmFName
                 cmFName = None
-            hf = PNMImage(hfFName)
-            self.gndWidth, self.gndHeight = hf.getXSize(), hf.getYSize()
+            elif os.path.getmtime(cmFName) < os.path.getmtime(hfSrcFName):
+                print("WARN:Terrain:CM:{}:Older than the heightfield, still using it, delete it to regenerate".format(cmFName))
         print("DBUG:Terrain:HF:{}:{}x{}".format(hfFile, hf.getXSize(), hf.getYSize()))
         # Colormap for the terrain
         if cmFName == None:
-            cm = self._create_colormap(hf)
+            cmArr = None
+            if hfSrcFName != None:
+                cmCacheFName = self._cmcache_fname(hfFile, hfSrcFName)
+                if os.path.exists(cmCacheFName):
+                    print("DBUG:Terrain:CMCache:Hit:{}".format(cmCacheFName))
+                    cmArr = numpy.load(cmCacheFName, mmap_mode='r')
+            if type(cmArr) == type(None):
+                cmArr = self._create_colormap(hf)
+                if hfSrcFName != None:
+                    self.cmCachePending = [ cmCacheFName, cmArr ]
+            cm = self._numpy2pnm(cmArr)
         else:
             cm = PNMImage(cmFName)
-        if cmFNameSave != None:
-            cm.write(cmFNameSave)
-        self.terrain.setHeightfield(hf)
-        self.terrain.setColorMap(cm)
-        blockSize = int((hf.getXSize()-1)/8)
-        lodFar = blockSize*4
-        lodNear = max(64,lodFar/4)
-        print("DBUG:Terrain:LOD:BlockSize:{}:Far:{}:Near:{}".format(blockSize, lodFar, lodNear))
-        self.terrain.setBlockSize(blockSize)
-        self.terrain.setNear(lodNear)
-        self.terrain.setFar(lodFar)
-        self.terrain.setFocalPoint(self.camera)
-        self.terrain.setAutoFlatten(self.cfg['LODAFMode'])
-        self.terrain.setBruteforce(self.cfg['bLODBruteForce'])
-        tRoot = self.terrain.getRoot()
-        #tRoot.setSx(4)
-        #tRoot.setSy(4)
-        tRoot.setSz(100)
-        tRoot.reparentTo(self.render)
-        self.terrain.generate()
+        # A single terrain (with the only copy of the heightfield and colormap, the latter being applied as
+        # vertex colors), which stays out of the scene graph. A copy of its generated mesh is shown, ie only
+        # the mesh is double buffered (refer to world_updater_tf).
+        self.terrainFocus = NodePath("GndFocus")
+        self.terrainFocus.setPos(self.cDefPos)
+        self.terrain = self._new_terrain("Gnd", hf, cm, self.terrainFocus)
+        self.terrainNP = self.terrain.getRoot().copyTo(self.render)
         print("DBUG:Terrain:AfterScale:{}x{}".format(self.terrain.heightfield().getXSize(), self.terrain.heightfield().getYSize()))
         # Add some objects
-        p = self.loader.loadModel("models/panda-model")
+        p = self.render.attachNewNode("Panda")
         p.setPos(50,100,0)
         p.setScale(0.01)
-        p.reparentTo(self.render)
+        self.place_model("models/panda-model", p)
+
+
+    def place_model(self, mPath, np):
+        """
+        Place (instance) the model of the given path under the passed node.
+        Each model path is loaded only once, in the background. Till it is loaded, a instance of the
+        shared cube is placed as a placeholder, which is replaced by the model once it is ready.
+        """
+        if self.modelProtos.get(mPath) != None:
+            self.modelProtos[mPath].instanceTo(np)
+            return
+        self.cubeProto.instanceTo(np.attachNewNode("Placeholder"))
+        # Either being loaded or failed to load
+        if mPath in self.modelProtos:
+            if mPath in self.modelsPending:
+                self.modelsPending[mPath].append(np)
+            return
+        self.modelsPending[mPath] = [ np ]
+        self.modelProtos[mPath] = None
+        self.loader.loadModel(mPath, callback=self._model_loaded, extraArgs=[ mPath ])
+
+
+    def _model_loaded(self, model, mPath):
+        """
+        Called once the given model path is loaded. Replace the placeholders of the nodes waiting on it with the model.
+        If the model couldnt be loaded, the placeholders are left as is.
+        """
+        lNPs = self.modelsPending.pop(mPath)
+        if model == None:
+            print("WARN:Models:{}:Failed to load, keeping placeholders for {} nodes".format(mPath, len(lNPs)))
+            return
+        self.modelProtos[mPath] = model
+        for np in lNPs:
+            np.find("Placeholder").removeNode()
+            model.instanceTo(np)
+        print("DBUG:Models:{}:Loaded:Nodes:{}".format(mPath, len(lNPs)))
+
+
+    def _create_tile_terrain(self, sName, hfRaw, cmFName, focus):
+        """
+        Create the terrain for a tile of the paged terrain (called from the pager thread).
+        """
+        return self._new_terrain(sName, self._numpy2pnm(hfRaw), PNMImage(cmFName), focus, bBorderStitching=True)
+
+
+    def create_terrain_paged(self, hfFile):
+        """
+        Create a paged terrain, from the heightfield and colormap tile pyramid of the passed terrain file
+        (refer to hkvc_imgutils p3dpyramid). Only the tiles around the camera are kept in the scene graph,
+        with them being loaded in the background as the camera moves (refer to p3dpager).
+        """
+        self.hfRaw = None
+        self.cmCachePending = None
+        self.terrain = None
+        self.terrainNP = None
+        self.pager = p3dpager.TerrainPager("{}.pyramid/manifest.json".format(hfFile), self._create_tile_terrain,
+                        self.cfg['iPagerLevel'], self.cfg['iPagerRadius'], self.cfg['iPagerBudgetMB'])
+        self.pager.root.reparentTo(self.render)
+        self.gndWidth, self.gndHeight = self.pager.iSize, self.pager.iSize
 
 
     def create_objects(self, baseFName, bFont3D=False):
         """
         Create objects corresponding to the entries in the objects file.
         For now it creates a floating cube with its name, wrt each entry.
+        The objects are kept as array records (position, name, model path and grid cell), with their
+        scene graph nodes created only when they come into range (refer to update_objects).
+        The cubes share a single cube geometry, and are batched per grid cell (refer to build_objects_cell),
+        as are their name labels (refer to build_labels_cell).
+        Entries with a model share a single copy of the model per path, which is loaded in the background
+        and instanced (refer to place_model), into nodes taken from a pool (refer to materialize_object).
         """
         objsFName = "{}.objects".format(baseFName)
+        self.objsGrid = None
+        self.objsVisGrid = None
+        self.objsVisible = set()
+        self.objsCells = {}
+        # The cell batches are kept in LRU order (least recently visible first)
+        self.objsCellBatches = collections.OrderedDict()
+        self.objsCellsVisible = set()
+        self.objsCellsNP = self.render.attachNewNode("ObjCells")
+        self.objsLabelBatches = collections.OrderedDict()
+        self.objsLabelsVisible = set()
+        self.objsLabelsNP = self.render.attachNewNode("ObjLabels")
+        # The nodes of the model objects in range, and the pool of free nodes by model path
+        self.objsNodes = {}
+        self.objsPool = {}
+        self.objsPoolHits = 0
+        self.objsPoolMisses = 0
+        self.objsModelsNP = self.render.attachNewNode("ObjModels")
+        self.objsNames = []
+        self.objsModels = []
+        self.objsCellOf = []
+        self.objsCnt = -1
+        self.objsDistThreshold = 0
+        self.objsCellSize = 1
         try:
             f = open(objsFName)
         except:
             print("WARN:CreateObjects:Returning empty handed")
             return
+        # A single font and text node, used to generate the labels of all objects (refer to build_labels_cell)
         if bFont3D:
-            ttfFont = loader.loadFont("data/comic.ttf", color = (1,1,1,1), renderMode = TextFont.RMSolid)
-        hf=self.terrain.heightfield()
+            font = loader.loadFont("data/comic.ttf", color = (1,1,1,1), renderMode = TextFont.RMSolid)
+        else:
+            font = TextNode.getDefaultFont()
+        self.objsLabelTN = TextNode("ObjLabel")
+        self.objsLabelTN.setFont(font)
+        self.objsLabelTN.setAlign(TextNode.ACenter)
+        self.objsLabelTN.setTextColor(0, 0, 0, 1)
+        self.objsLabelShader = Shader.make(Shader.SL_GLSL, LABEL_VSHADER, LABEL_FSHADER)
+        aFmt = GeomVertexArrayFormat()
+        aFmt.addColumn(InternalName.getVertex(), 3, Geom.NTFloat32, Geom.CPoint)
+        aFmt.addColumn(InternalName.getTexcoord(), 2, Geom.NTFloat32, Geom.CTexcoord)
+        aFmt.addColumn(InternalName.make("offset"), 3, Geom.NTFloat32, Geom.COther)
+        self.objsLabelFormat = GeomVertexFormat.registerFormat(aFmt)
         hdr1 = f.readline()
         hdr2 = f.readline()
         if not hdr2.startswith("HDR2:"):
             raise RuntimeError("ERRR:CreateObjects:Invalid Objects file:{}".format(objsFName))
         hdr2 = hdr2.split(":")
         oXW,oYH = int(hdr2[2]), int(hdr2[4])
-        cXW = hf.getXSize()
-        cYH = hf.getYSize()
+        cXW = self.gndWidth
+        cYH = self.gndHeight
         xMult = cXW/oXW
         yMult = cYH/oYH
         print("INFO:CreateObjects:Adj:{}x{}:{}x{}:{}x{}".format(oXW, oYH, cXW, cYH, xMult, yMult))
+        self.set_kmscale(hdr1, cXW, cYH)
         self.objsDistThreshold = int(max(cXW, cYH)/4)**2
+        # Cells small wrt the visibility distance, so that showing whole cells isnt very different from per object
+        self.objsCellSize = max(numpy.sqrt(self.objsDistThreshold)/4, 1)
         self.modelPaths = {}
-        self.objs = {}
-        self.objsNPA = numpy.zeros(1024*3).reshape(1024,3)
+        # Grows as needed
+        self.objsNPA = numpy.zeros((1024, 3))
         self.objsCnt = -1
         alreadyIn = set()
         for l in f:
@@ -303,6 +582,8 @@ class FSim(ShowBase):
             if name in alreadyIn:
                 continue
             self.objsCnt += 1
+            if self.objsCnt >= len(self.objsNPA):
+                self.objsNPA = numpy.concatenate((self.objsNPA, numpy.zeros_like(self.objsNPA)))
             alreadyIn.add(name)
             if len(la) > 3:
                 model = la[3].strip()
@@ -310,57 +591,307 @@ class FSim(ShowBase):
                 model = ''
             print("INFO:CreateObjects:{:4}:{:6}:{:4}x{:4}:{:4}x{:4}:{}".format(self.objsCnt, model, x, y, aX, aY, name))
             if model == '':
-                m1 = pp.create_cube("{}".format(self.objsCnt))
-                m1np = self.render.attachNewNode(m1)
-            else:
-                m1np = loader.loadModel(self.modelPaths[model])
-                m1np.reparentTo(self.render)
-            m1np.setPos(aX, aY, aZ)
-            m1np.setScale(4)
-            m1np.hide()
-            if model == '':
-                txt = OnscreenText(text=name)
-                txtn = txt.node()
-                if bFont3D:
-                    txtn.setFont(ttfFont)
-                txtnp = self.render.attachNewNode(txtn)
-                txtnp.setPos(aX+2, aY-1, aZ+1)
-                txtnp.setScale(10)
-                txtnp.hide()
+                cell = (int(aX//self.objsCellSize), int(aY//self.objsCellSize))
+                self.objsCells.setdefault(cell, []).append(self.objsCnt)
+                self.objsModels.append(None)
             else:
-                txtnp = None
-            self.objs[self.objsCnt] = { 'm': m1np, 't': txtnp, 'n': name }
+                cell = None
+                self.objsModels.append(self.modelPaths[model])
+            self.objsNames.append(name)
+            self.objsCellOf.append(cell)
             self.objsNPA[self.objsCnt] = [aX, aY, aZ]
+        self.objsGrid = og.ObjGrid(self.objsNPA[:self.objsCnt+1,:2]*self.kmScale)
+        self.objsVisGrid = og.ObjGrid(self.objsNPA[:self.objsCnt+1,:2])
+        self.objsNearest = None
+        print("INFO:CreateObjects:Objects:{}:CubeCells:{}:ModelPaths:{}".format(self.objsCnt+1, len(self.objsCells), len(self.modelPaths)))
+
+
+    def materialize_object(self, i):
+        """
+        Create the scene graph node of the given model object, reusing a free node of its model from the pool, if any.
+        """
+        mPath = self.objsModels[i]
+        lFree = self.objsPool.setdefault(mPath, [])
+        if len(lFree) > 0:
+            np = lFree.pop()
+            self.objsPoolHits += 1
+        else:
+            np = NodePath("ObjModel")
+            np.setScale(4)
+            self.place_model(mPath, np)
+            self.objsPoolMisses += 1
+        np.setPos(*self.objsNPA[i])
+        np.reparentTo(self.objsModelsNP)
+        self.objsNodes[i] = np
+
+
+    def release_object(self, i):
+        """
+        Remove the node of the given model object from the scene graph, and return it to the pool.
+        """
+        np = self.objsNodes.pop(i)
+        np.detachNode()
+        self.objsPool[self.objsModels[i]].append(np)
+
+
+    def build_objects_cell(self, cell):
+        """
+        Build (if not already built) the batch node of the cubes in the given grid cell, and return it.
+        Each cube is a copy of the world update thread's cube geometry, with the copies then merged into
+        a single geom by flattenStrong, so that the cell is drawn in one go. As flattening goes through
+        instances and would modify the shared geometry itself, copyTo is used rather than instanceTo.
+        It is called from the world update thread, with the batch attached to the scene graph later.
+        The thread has its own cube (cubeProtoWU), so that it doesnt copy from the cube, which the main
+        thread uses for the placeholders.
+        """
+        batch = self.objsCellBatches.get(cell)
+        if batch != None:
+            return batch
+        batch = NodePath("ObjCell{}_{}".format(cell[0], cell[1]))
+        for i in self.objsCells[cell]:
+            np = batch.attachNewNode("Obj{}".format(i))
+            np.setPos(*self.objsNPA[i])
+            np.setScale(4)
+            self.cubeProtoWU.copyTo(np)
+        batch.flattenStrong()
+        self.objsCellBatches[cell] = batch
+        return batch
+
+
+    def build_labels_cell(self, cell):
+        """
+        Build (if not already built) the batch node of the name labels of the cubes in the given grid cell, and return it.
+        The labels are generated from the single label text node, and their triangles merged into a single geom (per
+        glyph texture of the font, so normally one), with each vertex at its label's anchor, along with its offset
+        within the label. The label shader (LABEL_VSHADER) applies the offsets in view space, so that the labels face
+        the camera. Like the cube batches, they are kept around and reused, when the cell becomes visible again.
+        It is called from the main thread (refer to update_objects), as generating the text can add glyphs to the
+        shared dynamic font.
+        """
+        batch = self.objsLabelBatches.get(cell)
+        if batch != None:
+            return batch
+        dGeoms = {}
+        fMaxOffset = 0
+        for i in self.objsCells[cell]:
+            self.objsLabelTN.setText(self.objsNames[i])
+            label = NodePath("Label")
+            label.attachNewNode(self.objsLabelTN.generate()).setScale(0.7)
+            label.flattenStrong()
+            aX, aY, aZ = self.objsNPA[i]
+            for gnp in label.findAllMatches("**/+GeomNode"):
+                gn = gnp.node()
+                for j in range(gn.getNumGeoms()):
+                    state = gn.getGeomState(j)
+                    geom = gn.getGeom(j).decompose()
+                    if state not in dGeoms:
+                        dGeoms[state] = [ GeomVertexData("ObjLabels", self.objsLabelFormat, Geom.UHStatic), GeomTriangles(Geom.UHStatic) ]
+                    vdata, prim = dGeoms[state]
+                    iBase = vdata.getNumRows()
+                    rV = GeomVertexReader(geom.getVertexData(), "vertex")
+                    bTex = geom.getVertexData().hasColumn("texcoord")
+                    if bTex:
+                        rT = GeomVertexReader(geom.getVertexData(), "texcoord")
+                    wV = GeomVertexWriter(vdata, "vertex")
+                    wT = GeomVertexWriter(vdata, "texcoord")
+                    wO = GeomVertexWriter(vdata, "offset")
+                    for w in [ wV, wT, wO ]:
+                        w.setRow(iBase)
+                    while not rV.isAtEnd():
+                        v = rV.getData3()
+                        fMaxOffset = max(fMaxOffset, v.length())
+                        wV.addData3(aX+2, aY-1, aZ+1)
+                        wO.addData3(v)
+                        wT.addData2(rT.getData2() if bTex else (0, 0))
+                    for k in range(geom.getNumPrimitives()):
+                        p = geom.getPrimitive(k)
+                        for n in range(p.getNumVertices()):
+                            prim.addVertex(iBase+p.getVertex(n))
+        gn = GeomNode("ObjLabels{}_{}".format(cell[0], cell[1]))
+        for state in dGeoms:
+            vdata, prim = dGeoms[state]
+            geom = Geom(vdata)
+            geom.addPrimitive(prim)
+            gn.addGeom(geom, state)
+        # The bounds are wrt the anchors, so grow them by the label size, for culling
+        bounds = gn.getBounds()
+        if not bounds.isEmpty():
+            bounds = BoundingSphere(bounds.getCenter(), bounds.getRadius()+fMaxOffset)
+            gn.setBounds(bounds)
+            for j in range(gn.getNumGeoms()):
+                gn.modifyGeom(j).setBounds(bounds)
+        batch = NodePath(gn)
+        batch.setShader(self.objsLabelShader)
+        batch.setTransparency(True)
+        self.objsLabelBatches[cell] = batch
+        return batch
+
+
+    def find_labels_visible(self, pos, sCells):
+        """
+        Find the label batches to show, out of the passed visible cells, along with their alpha.
+        The labels fade out over the farther half of the objects visibility distance (wrt the cell center),
+        and are culled beyond it.
+        """
+        fFar = numpy.sqrt(self.objsDistThreshold)
+        dLabels = {}
+        for cell in sCells:
+            d = numpy.hypot((cell[0]+0.5)*self.objsCellSize-pos.x, (cell[1]+0.5)*self.objsCellSize-pos.y)
+            fAlpha = min(max((fFar-d)/(fFar*0.5), 0), 1)
+            if fAlpha > 0:
+                dLabels[cell] = fAlpha
+        return dLabels
+
+
+    def set_kmscale(self, hdr1, cXW, cYH):
+        """
+        Setup the km per unit along x and y of the 3d world, from the geo bounds in the HDR1 line of the objects file.
+        Distances are treated as flat (equirectangular) around the center of the terrain.
+        If the geo bounds arent available, the world units are used as is.
+        """
+        self.kmScale = numpy.array([1.0, 1.0])
+        self.kmUnits = "u"
+        hdr1 = hdr1.strip().split(":")
+        if (hdr1[0] != "HDR1") or (len(hdr1) < 9):
+            print("WARN:CreateObjects:No geo bounds, distances will be in world units")
+            return
+        sLon, eLon, sLat, eLat = float(hdr1[2]), float(hdr1[4]), float(hdr1[6]), float(hdr1[8])
+        kmPerDeg = 111.32
+        self.kmScale[0] = abs(eLon-sLon)/cXW*kmPerDeg*numpy.cos(numpy.radians((sLat+eLat)/2))
+        self.kmScale[1] = abs(eLat-sLat)/cYH*kmPerDeg
+        self.kmUnits = "km"
+        print("INFO:CreateObjects:KmPerUnit:{}".format(self.kmScale))
+
+
+    def update_nearest(self, cPo):
+        """
+        Show the nearest object (airfield) and its distance in the HUD.
+        The previous nearest is used to bound the search (refer to ObjGrid.knn).
+        """
+        if (self.objsGrid == None) or (self.objsGrid.count == 0):
+            self.hud['Nav'].setText("N:None")
+            return
+        lNear = self.objsGrid.knn(cPo.x*self.kmScale[0], cPo.y*self.kmScale[1], 1, self.objsNearest)
+        self.objsNearest = [ i for i, d in lNear ]
+        i, d = lNear[0]
+        self.hud['Nav'].setText("N:{:8}:{:08.2f}{}".format(self.objsNames[i], d, self.kmUnits))
 
 
-    def update_objects(self):
+    def find_objects_visible(self, pos):
         """
-        Based on distance wrt current plane position, decide whether to show a object or not.
+        Based on distance wrt the passed position, find the set of objects to show.
+        Only the objects in the grid cells around the position are looked at (refer to ObjGrid.radius).
         NOTE: It doesnt worry about z axis(ie height).
         """
-        tX = self.objsNPA[:,0] - self.uoPos.x
-        tY = self.objsNPA[:,1] - self.uoPos.y
-        d = tX**2 + tY**2
-        l = numpy.argwhere(d < self.objsDistThreshold)
-        print("INFO:UpdateObjects:", self.uoPos, self.objsDistThreshold, l[l < self.objsCnt])
-        for i in range(self.objsCnt):
-            if i in l:
-                self.objs[i]['m'].show()
-                if self.objs[i]['t'] != None:
-                    self.objs[i]['t'].show()
-                print(self.objs[i]['n'], d[i])
-            else:
-                self.objs[i]['m'].hide()
-                if self.objs[i]['t'] != None:
-                    self.objs[i]['t'].hide()
+        if (self.objsVisGrid == None) or (self.objsVisGrid.count == 0):
+            return set()
+        r = numpy.sqrt(self.objsDistThreshold)
+        return set([ i for i, d in self.objsVisGrid.radius(pos.x, pos.y, r) if d < r ])
 
 
-    def update_world_tf(self):
+    def update_objects(self, pos, sVisible, sCells, dLabels):
+        """
+        Materialize the model objects which have come into range and release the ones which went out of range
+        back to the pool, wrt the previous visible set, leaving the others untouched.
+        The cube batches are attached/detached similarly, only when the set of visible cells changes.
+        The label batches are attached/detached as per dLabels (building them as needed), with their alpha updated.
+        The cell batches which arent visible are kept around for reuse, upto iObjsCellCache of them.
         """
-        The thread function, which triggers the objects and terrain update logics within it.
+        sShow = sVisible - self.objsVisible
+        sHide = self.objsVisible - sVisible
+        for i in sHide:
+            if i in self.objsNodes:
+                self.release_object(i)
+        for i in sShow:
+            if self.objsModels[i] != None:
+                self.materialize_object(i)
+        self.objsVisible = sVisible
+        if sCells != self.objsCellsVisible:
+            for cell in sCells - self.objsCellsVisible:
+                self.objsCellBatches[cell].reparentTo(self.objsCellsNP)
+            for cell in self.objsCellsVisible - sCells:
+                self.objsCellBatches[cell].detachNode()
+            self.objsCellsVisible = sCells
+        for cell in self.objsLabelsVisible - set(dLabels):
+            self.objsLabelBatches[cell].detachNode()
+        for cell in dLabels:
+            if cell not in self.objsLabelsVisible:
+                self.build_labels_cell(cell).reparentTo(self.objsLabelsNP)
+            self.objsLabelBatches[cell].setAlphaScale(dLabels[cell])
+        self.objsLabelsVisible = set(dLabels)
+        self._trim_batches(self.objsCellBatches, sCells)
+        self._trim_batches(self.objsLabelBatches, self.objsLabelsVisible)
+        print("INFO:UpdateObjects:{}:Visible:{}:Shown:{}:Hidden:{}:Cells:{}:Labels:{}".format(pos, len(sVisible), len(sShow), len(sHide), len(sCells), len(dLabels)))
+        iLookups = self.objsPoolHits + self.objsPoolMisses
+        print("DBUG:UpdateObjects:Pool:Live:{}:Free:{}:Hits:{}:Misses:{}:HitRate:{:.2f}:CellBatches:{}:LabelBatches:{}".format(
+            len(self.objsNodes), sum([ len(l) for l in self.objsPool.values() ]), self.objsPoolHits, self.objsPoolMisses,
+            self.objsPoolHits/iLookups if iLookups > 0 else 0, len(self.objsCellBatches), len(self.objsLabelBatches)))
+
+
+    def _trim_batches(self, dBatches, sVisible):
         """
-        self.update_objects()
-        self.terrain.update()
+        Mark the visible cell batches as recently used, and drop the least recently visible ones beyond iObjsCellCache.
+        """
+        for cell in sVisible:
+            dBatches.move_to_end(cell)
+        for cell in list(dBatches.keys()):
+            if len(dBatches) <= self.cfg['iObjsCellCache']:
+                break
+            if cell in sVisible:
+                continue
+            dBatches.pop(cell).removeNode()
+
+
+    def world_updater_tf(self):
+        """
+        The world update worker thread function.
+        It picks up the latest update request (a request which wasnt started before a newer one came, is dropped),
+        finds the objects visible from the requested position (building the batches of their cells as needed)
+        and updates the lod of the terrain (which isnt in the scene graph) wrt it. If the mesh changed, a copy
+        of it is made, which shares the geoms of the terrain blocks (GeoMipTerrain replaces rather than modifies
+        the geom of a block, when its lod changes), so only the changed blocks take up more memory.
+        The result is swapped into the scene graph by apply_world_update.
+        As the batch caches are trimmed when applying, it waits for the previous result to be applied before
+        starting the next.
+        """
+        while True:
+            with self.wuCond:
+                while (self.wuRequest == None) or (self.wuResult != None):
+                    self.wuCond.wait()
+                pos, iFrame, tReq = self.wuRequest
+                self.wuRequest = None
+            sVisible = self.find_objects_visible(pos)
+            sCells = set([ self.objsCellOf[i] for i in sVisible if self.objsCellOf[i] != None ])
+            for cell in sCells:
+                self.build_objects_cell(cell)
+            dLabels = self.find_labels_visible(pos, sCells)
+            terrainNP = None
+            # In bruteforce mode, the lod doesnt change
+            if (self.terrain != None) and (not self.cfg['bLODBruteForce']):
+                self.terrainFocus.setPos(pos)
+                if self.terrain.update():
+                    terrainNP = self.terrain.getRoot().copyTo(NodePath())
+            with self.wuCond:
+                self.wuResult = [ pos, iFrame, tReq, terrainNP, sVisible, sCells, dLabels ]
+
+
+    def apply_world_update(self):
+        """
+        Swap the result of the world update worker (if any) into the scene graph, at the frame boundary.
+        """
+        with self.wuCond:
+            if self.wuResult == None:
+                return
+            pos, iFrame, tReq, terrainNP, sVisible, sCells, dLabels = self.wuResult
+        if terrainNP != None:
+            terrainNP.reparentTo(self.render)
+            self.terrainNP.removeNode()
+            self.terrainNP = terrainNP
+        self.update_objects(pos, sVisible, sCells, dLabels)
+        with self.wuCond:
+            self.wuResult = None
+            self.wuCond.notify()
+        print("DBUG:WorldUpdate:Pos:{}:Latency:{:.1f}ms:Frames:{}:Dropped:{}".format(pos, (time.time()-tReq)*1000, self.frameCnt-iFrame, self.wuDropped))
 
 
     def update_instruments_text(self, cPo, cOr, cTr, cRo):
@@ -381,8 +912,7 @@ class FSim(ShowBase):
         """
         Switch y between 3d and Image Co-Ords
         """
-        hf=self.terrain.heightfield()
-        return hf.getYSize() - y - 1
+        return self.gndHeight - y - 1
 
 
     def update_xyheight_3d(self, x, y):
@@ -399,8 +929,18 @@ class FSim(ShowBase):
         Get the height of the ground/terrain wrt the passed x,y location in texture/colormap/image space.
         NOTE: The found value is stored into a internal variable.
         """
-        hf=self.terrain.heightfield()
-        self.terrainXYHeight = hf.getGray(x, y)*self.terrain.getRoot().getSz()
+        if self.pager != None:
+            h = self.pager.height_img(x, y)
+            if h == None:
+                raise IndexError("UpdateXYHeightImg:{},{} outside terrain".format(x, y))
+        elif type(self.hfRaw) == type(None):
+            hf=self.terrain.heightfield()
+            h = hf.getGray(x, y)
+        else:
+            if (x < 0) or (y < 0):
+                raise IndexError("UpdateXYHeightImg:{},{} outside terrain".format(x, y))
+            h = self.hfRaw[y, x]*self.hfRawScale
+        self.terrainXYHeight = h*self.terrainSz
 
 
     def update_terrain_height(self, cPos):
@@ -421,12 +961,17 @@ class FSim(ShowBase):
 
     def update_world(self, cPos):
         """
-        The helper which calls the thread for updating the world.
+        Request the world update worker to update the world wrt the passed position.
+        Any earlier request, which the worker hasnt started on yet, is replaced.
+        In paged mode, the terrain pager is requested to update the terrain tiles.
         """
-        self.uoPos.x = cPos.x
-        self.uoPos.y = cPos.y
-        self.uoPos.z = cPos.z
-        self.threadUpdate.run()
+        if self.pager != None:
+            self.pager.request(cPos)
+        with self.wuCond:
+            if self.wuRequest != None:
+                self.wuDropped += 1
+            self.wuRequest = [ Vec3(cPos), self.frameCnt, time.time() ]
+            self.wuCond.notify()
 
 
     def update(self, task):
@@ -436,6 +981,13 @@ class FSim(ShowBase):
             return Task.cont
         self.prevFrameTime = task.time
         self.frameCnt += 1
+        # Save the colormap cache, once the first frame is up
+        if (self.cmCachePending != None) and (self.frameCnt > 1):
+            threading.Thread(target=self._save_cmcache, args=self.cmCachePending).start()
+            self.cmCachePending = None
+        self.apply_world_update()
+        if self.pager != None:
+            self.pager.apply()
         cPo = self.camera.getPos()
         cOr = self.camera.getHpr()
         cTr = self.ctrans
@@ -450,6 +1002,7 @@ class FSim(ShowBase):
             self.hud['S1'].setText("NU:{:05.2f}".format(updateDelta))
             self.update_terrain_height(cPo)
             self.update_instruments_text(cPo, cOr, cTr, cRo)
+            self.update_nearest(cPo)
         # Update log
         if (self.frameCnt%2400) == 0:
             curT = time.time()
@@ -584,7 +1137,12 @@ class FSim(ShowBase):
         else:
             self.disableMouse()
         self.setup_lights()
-        self.threadUpdate = threading.Thread(target=self.update_world_tf)
+        self.wuCond = threading.Condition()
+        self.wuRequest = None
+        self.wuResult = None
+        self.wuDropped = 0
+        self.threadUpdate = threading.Thread(target=self.world_updater_tf, daemon=True)
+        self.threadUpdate.start()
         self.update_world(self.cDefPos)
         if self.cfg['bModeAC']:
             self.setup_ac_keyshandler()
@@ -606,6 +1164,11 @@ def handle_args(args):
         'bP3DCameraControl': False,
         'LODAFMode': GeoMipTerrain.AFMOff,
         'iLODMinLevel': 0,
+        'bTerrainPaged': False,
+        'iPagerLevel': -1,
+        'iPagerRadius': 1,
+        'iPagerBudgetMB': 256,
+        'iObjsCellCache': 256,
         }
     iArg = 0
     while iArg < (len(args)-1):
@@ -0,0 +1,114 @@
+# A uniform grid spatial index over 2d points, for nearest and within radius queries
+# HanishKVC, 2021
+# GPL
+#
+# The points are sorted by the grid cell they fall in, with the start of each cell's points recorded,
+# so that the points in a given cell can be got directly. The per point data is also kept as python lists,
+# as the queries typically look at only a handful of points, where numpy's per call overhead dominates.
+#
+
+import math
+import numpy
+
+
+class ObjGrid():
+
+    def __init__(self, xy, cellSize=None):
+        self.build(xy, cellSize)
+
+    def build(self, xy, cellSize=None):
+        """
+        Build the index over the passed points (a array of shape [N, 2]).
+        If cellSize isnt given, its chosen so that there are about 4 points per cell on average.
+        """
+        xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+        self.count = len(xy)
+        if self.count == 0:
+            xy = numpy.zeros((1, 2))
+        self.minX, self.minY = xy.min(axis=0)
+        maxX, maxY = xy.max(axis=0)
+        if cellSize == None:
+            cellSize = math.sqrt(max((maxX-self.minX)*(maxY-self.minY), 1e-6)*4/max(self.count, 1))
+        self.cellSize = max(cellSize, 1e-6)
+        self.nX = int((maxX-self.minX)/self.cellSize)+1
+        self.nY = int((maxY-self.minY)/self.cellSize)+1
+        iCX = ((xy[:,0]-self.minX)/self.cellSize).astype(numpy.int64)
+        iCY = ((xy[:,1]-self.minY)/self.cellSize).astype(numpy.int64)
+        iCell = iCY*self.nX + iCX
+        iOrder = numpy.argsort(iCell, kind='stable')
+        cellStart = numpy.zeros(self.nX*self.nY+1, dtype=numpy.int64)
+        cellStart[1:] = numpy.cumsum(numpy.bincount(iCell, minlength=self.nX*self.nY))
+        if self.count == 0:
+            cellStart[:] = 0
+            iOrder = iOrder[:0]
+        self.lCellStart = cellStart.tolist()
+        self.lIdx = iOrder.tolist()
+        self.lX = xy[iOrder,0].tolist()
+        self.lY = xy[iOrder,1].tolist()
+        self.lPX = xy[:,0].tolist()
+        self.lPY = xy[:,1].tolist()
+
+    def _cell_range(self, x0, y0, x1, y1):
+        cX0 = max(int((x0-self.minX)//self.cellSize), 0)
+        cX1 = min(int((x1-self.minX)//self.cellSize), self.nX-1)
+        cY0 = max(int((y0-self.minY)//self.cellSize), 0)
+        cY1 = min(int((y1-self.minY)//self.cellSize), self.nY-1)
+        return cX0, cY0, cX1, cY1
+
+    def _count(self, cX0, cY0, cX1, cY1):
+        iCnt = 0
+        for cY in range(cY0, cY1+1):
+            iCnt += self.lCellStart[cY*self.nX+cX1+1] - self.lCellStart[cY*self.nX+cX0]
+        return iCnt
+
+    def radius(self, x, y, r):
+        """
+        Get the points within distance r of x,y, as a list of (index, distance), in no particular order.
+        """
+        if (self.count == 0) or (r < 0):
+            return []
+        cX0, cY0, cX1, cY1 = self._cell_range(x-r, y-r, x+r, y+r)
+        r2 = r*r
+        lRes = []
+        for cY in range(cY0, cY1+1):
+            for i in range(self.lCellStart[cY*self.nX+cX0], self.lCellStart[cY*self.nX+cX1+1]):
+                dX = self.lX[i]-x
+                dY = self.lY[i]-y
+                d2 = dX*dX + dY*dY
+                if d2 <= r2:
+                    lRes.append((self.lIdx[i], math.sqrt(d2)))
+        return lRes
+
+    def knn(self, x, y, k=1, lPrev=None):
+        """
+        Get the k nearest points to x,y, as a list of (index, distance), sorted by distance.
+        lPrev (the indexes from a previous query, say of the last frame) if given, is used to bound
+        the search radius, as the k nearest cant be farther than the farthest of these k points.
+        Else the search radius is found by growing a square of cells around x,y, till it contains k points.
+        """
+        k = min(k, self.count)
+        if k <= 0:
+            return []
+        r = None
+        if (lPrev != None) and (len(lPrev) >= k):
+            lD = sorted([ math.hypot(self.lPX[i]-x, self.lPY[i]-y) for i in lPrev ])
+            r = lD[k-1]
+        if r == None:
+            cX = min(max(int((x-self.minX)//self.cellSize), 0), self.nX-1)
+            cY = min(max(int((y-self.minY)//self.cellSize), 0), self.nY-1)
+            iRing = 0
+            while True:
+                cR = (max(cX-iRing, 0), max(cY-iRing, 0), min(cX+iRing, self.nX-1), min(cY+iRing, self.nY-1))
+                if self._count(*cR) >= k:
+                    break
+                iRing += 1
+            lD = []
+            for cYi in range(cR[1], cR[3]+1):
+                for i in range(self.lCellStart[cYi*self.nX+cR[0]], self.lCellStart[cYi*self.nX+cR[2]+1]):
+                    lD.append(math.hypot(self.lX[i]-x, self.lY[i]-y))
+            lD.sort()
+            r = lD[k-1]
+        # Pad the radius a bit, so that the rounding in the distance calculations doesnt drop the kth point
+        lRes = self.radius(x, y, r*(1+1e-9)+1e-9)
+        lRes.sort(key=lambda e: e[1])
+        return lRes[:k]
@@ -0,0 +1,236 @@
+# A paged terrain, made up of a grid of GeoMipTerrain tiles from a heightfield/colormap tile pyramid
+# HanishKVC, 2021
+# GPL
+#
+# The tiles of one level of the pyramid (refer to hkvc_imgutils p3dpyramid and its manifest.json)
+# are placed side by side in the 3d world, with tile 0,0 (the top left one in image space) at the top
+# left ie larger y. Neighbouring tiles share their border row/col, and the tile terrains are created
+# with border stitching (ie full detail at the borders), so that tiles with differing lod meet without seams.
+#
+# The tiles within iRadius tiles of the requested position are wanted. A background thread loads and
+# generates the missing wanted tiles (nearest first), and updates the lod of the resident ones. The tile
+# terrains themselves never enter the scene graph, rather a copy of their mesh is shown (as done for the
+# single terrain in fsim), which the thread makes after generating or updating a tile. The loaded tiles
+# and updated meshes are swapped into the scene graph by apply, called from the frame task, which also
+# detaches the tiles which are no longer wanted. The detached tiles are kept around in a LRU cache, till
+# the estimated memory of the resident tiles exceeds the budget.
+#
+
+import sys, os
+import json
+import math
+import time
+import collections
+
+from panda3d.core import NodePath, Vec3
+from direct.stdpy import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+import hfr
+
+
+# Rough memory used per heightfield pixel of a generated tile, ie the heightfield and colormap PNMImages,
+# and the terrain mesh (along with its shown copy).
+TILE_BYTES_PER_PIXEL = 64
+
+
+class TerrainPager():
+
+    def __init__(self, sManifest, fnCreateTerrain, iLevel=-1, iRadius=1, iBudgetMB=256):
+        """
+        sManifest: the manifest.json of the tile pyramid.
+        fnCreateTerrain(sName, hfRaw, cmFName, focus): creates and generates a GeoMipTerrain (not attached
+            to the scene graph) for the given tile heightfield (as in hfr.load) and colormap file, with its lod
+            based on the passed focal point node. It is called from the pager thread.
+        iLevel: the pyramid level to use, -1 for the finest.
+        """
+        f = open(sManifest)
+        self.manifest = json.load(f)
+        f.close()
+        self.sDir = os.path.dirname(os.path.abspath(sManifest))
+        self.fnCreateTerrain = fnCreateTerrain
+        if iLevel < 0:
+            iLevel = self.manifest['levels']-1
+        self.iLevel = iLevel
+        self.iTileSize = self.manifest['tileSize']
+        self.iTiles = 2**iLevel
+        self.iSize = (self.iTileSize-1)*self.iTiles+1
+        self.iRadius = iRadius
+        self.iBudget = iBudgetMB*1024*1024
+        self.iTileBytes = self.iTileSize*self.iTileSize*TILE_BYTES_PER_PIXEL
+        print("INFO:TerrainPager:{}:Level:{}:Tiles:{}x{}:TileSize:{}:WorldSize:{}".format(sManifest, iLevel, self.iTiles, self.iTiles, self.iTileSize, self.iSize))
+        self.root = NodePath("TerrainPager")
+        # The focal point for the lod of the tiles, used only by the pager thread
+        self.focus = NodePath("TerrainPagerFocus")
+        # The resident tiles in LRU order (least recently wanted first), the ones loaded but not yet applied,
+        # the updated meshes of the resident tiles not yet applied, and the tile the pager thread is working on
+        self.dTiles = collections.OrderedDict()
+        self.dReady = {}
+        self.dMeshes = {}
+        self.busyKey = None
+        # The memory mapped tile heightfields used by height_img, in LRU order
+        self.dHFs = collections.OrderedDict()
+        self.iMaxHFs = max(self.iBudget//self.iTileBytes, (2*iRadius+1)**2)
+        self.lWanted = []
+        self.reqPos = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.pager_tf, daemon=True)
+        self.thread.start()
+
+
+    def tile_key(self, tx, ty):
+        return "{}/{}/{}".format(self.iLevel, tx, ty)
+
+
+    def tile_origin(self, tx, ty):
+        """
+        Get the 3d world x,y of the (bottom left) origin of the given tile.
+        """
+        return tx*(self.iTileSize-1), (self.iTiles-1-ty)*(self.iTileSize-1)
+
+
+    def wanted_tiles(self, pos):
+        """
+        Get the keys of the tiles within iRadius tiles of the passed 3d world position, nearest first.
+        """
+        tS = self.iTileSize-1
+        cX = min(max(int(pos.x//tS), 0), self.iTiles-1)
+        cY = min(max(int((self.iSize-1-pos.y)//tS), 0), self.iTiles-1)
+        lWanted = []
+        for ty in range(max(cY-self.iRadius, 0), min(cY+self.iRadius, self.iTiles-1)+1):
+            for tx in range(max(cX-self.iRadius, 0), min(cX+self.iRadius, self.iTiles-1)+1):
+                oX, oY = self.tile_origin(tx, ty)
+                d = math.hypot(oX+tS/2-pos.x, oY+tS/2-pos.y)
+                lWanted.append([d, self.tile_key(tx, ty), tx, ty])
+        lWanted.sort()
+        return [ w[1:] for w in lWanted ]
+
+
+    def request(self, pos):
+        """
+        Request the tiles around the passed 3d world position to be loaded and their lod updated.
+        Any earlier request, which the pager thread hasnt got to yet, is replaced.
+        """
+        lWanted = self.wanted_tiles(pos)
+        with self.cond:
+            self.reqPos = Vec3(pos)
+            self.lWanted = lWanted
+            self.cond.notify()
+
+
+    def _load_tile(self, key, tx, ty):
+        dTile = self.manifest['tiles'][key]
+        tStart = time.time()
+        hdr, hfRaw = hfr.load(os.path.join(self.sDir, dTile['hfr']))
+        terrain = self.fnCreateTerrain("Tile{}_{}".format(tx, ty), hfRaw, os.path.join(self.sDir, dTile['cm']), self.focus)
+        oX, oY = self.tile_origin(tx, ty)
+        terrain.getRoot().setPos(oX, oY, 0)
+        print("DBUG:TerrainPager:Load:{}:{:.1f}ms".format(key, (time.time()-tStart)*1000))
+        return { 'terrain': terrain, 'np': terrain.getRoot().copyTo(NodePath()), 'bAttached': False }
+
+
+    def pager_tf(self):
+        """
+        The pager thread function. For the latest request, it goes through the wanted tiles nearest first,
+        updating the lod of the resident ones and loading the others. If a newer request comes in, the rest
+        of the current one is dropped.
+        The tile terrains are not part of the scene graph. When the mesh of a resident tile changes, a copy
+        of it (sharing the geoms of the unchanged blocks) is queued for apply to swap in. The tile being
+        worked on is marked busy, so that apply doesnt evict it meanwhile.
+        """
+        while True:
+            with self.cond:
+                while self.reqPos == None:
+                    self.cond.wait()
+                pos = self.reqPos
+                lWanted = self.lWanted
+                self.reqPos = None
+            self.focus.setPos(pos)
+            for key, tx, ty in lWanted:
+                with self.cond:
+                    if self.reqPos != None:
+                        break
+                    tile = self.dTiles.get(key, self.dReady.get(key))
+                    self.busyKey = key
+                if tile == None:
+                    tile = self._load_tile(key, tx, ty)
+                    with self.cond:
+                        self.dReady[key] = tile
+                        self.busyKey = None
+                    continue
+                np = None
+                if tile['terrain'].update():
+                    np = tile['terrain'].getRoot().copyTo(NodePath())
+                with self.cond:
+                    if np != None:
+                        if key in self.dMeshes:
+                            self.dMeshes[key].removeNode()
+                        self.dMeshes[key] = np
+                    self.busyKey = None
+
+
+    def apply(self):
+        """
+        Attach the loaded wanted tiles to the scene graph and detach the unwanted ones, swapping in the
+        updated meshes of the resident tiles (refer to pager_tf).
+        Then evict the least recently wanted detached tiles (other than the one the pager thread is working on),
+        till within the memory budget.
+        This is called from the frame task, so that the scene graph changes happen at a frame boundary.
+        """
+        with self.cond:
+            sWanted = set([ w[0] for w in self.lWanted ])
+            self.dTiles.update(self.dReady)
+            self.dReady = {}
+            for key in self.dMeshes:
+                tile = self.dTiles.get(key)
+                if tile == None:
+                    self.dMeshes[key].removeNode()
+                    continue
+                if tile['bAttached']:
+                    self.dMeshes[key].reparentTo(self.root)
+                tile['np'].removeNode()
+                tile['np'] = self.dMeshes[key]
+            self.dMeshes = {}
+            for key in list(self.dTiles.keys()):
+                tile = self.dTiles[key]
+                if key in sWanted:
+                    self.dTiles.move_to_end(key)
+                    if not tile['bAttached']:
+                        tile['np'].reparentTo(self.root)
+                        tile['bAttached'] = True
+                elif tile['bAttached']:
+                    tile['np'].detachNode()
+                    tile['bAttached'] = False
+            for key in list(self.dTiles.keys()):
+                if len(self.dTiles)*self.iTileBytes <= self.iBudget:
+                    break
+                if (key in sWanted) or (key == self.busyKey):
+                    continue
+                tile = self.dTiles.pop(key)
+                tile['np'].removeNode()
+                tile['terrain'].getRoot().removeNode()
+                print("DBUG:TerrainPager:Evict:{}:Resident:{}:{:.1f}MB".format(key, len(self.dTiles), len(self.dTiles)*self.iTileBytes/(1024*1024)))
+
+
+    def height_img(self, x, y):
+        """
+        Get the height (0.0 to 1.0) at the passed x,y in the image space of the full paged terrain,
+        or None if it is outside the terrain. The tile heightfields are memory mapped for this, as needed,
+        so it doesnt depend on the tile being resident, and the least recently used ones are dropped
+        beyond the number of tiles which fit in the memory budget.
+        """
+        if (x < 0) or (y < 0) or (x >= self.iSize) or (y >= self.iSize):
+            return None
+        tS = self.iTileSize-1
+        tx = min(x//tS, self.iTiles-1)
+        ty = min(y//tS, self.iTiles-1)
+        key = self.tile_key(tx, ty)
+        if key in self.dHFs:
+            self.dHFs.move_to_end(key)
+        else:
+            hdr, hfRaw = hfr.load(os.path.join(self.sDir, self.manifest['tiles'][key]['hfr']))
+            self.dHFs[key] = [ hfRaw, hdr['scale'] ]
+            while len(self.dHFs) > self.iMaxHFs:
+                self.dHFs.popitem(last=False)
+        hfRaw, scale = self.dHFs[key]
+        return hfRaw[y-ty*tS, x-tx*tS]*scale
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Benchmark the imgutils terrain pipeline stages.
+# It generates synthetic GeoTiffs (with valid ModelTiepoint and ModelPixelScale tags) of the
+# requested sizes, and times each stage of the pipeline on them, along with the peak RSS seen
+# during the stage. The results are saved into a json file.
+# Each stage is run iRepeat times, with the min time and median RSS delta kept, along with their
+# spread (max-min) across the runs.
+# If a baseline json (from a previous run) is passed, the results are compared against it and
+# stages which have become slower or hungrier beyond the given tolerance, as well as beyond the
+# run to run spread, are flagged.
+# HanishKVC, 2021
+# GPL
+#
+
+
+import sys
+import os
+import json
+import time
+import platform
+import threading
+import multiprocessing
+import numpy
+import PIL.Image
+import PIL.TiffImagePlugin
+import imgutils as iu
+import odb
+
+
+gCfg = {
+        'sSizes': "513,2049,8193",
+        'sWorkDir': "/tmp/bench_imgutils",
+        'sOut': "bench_imgutils.json",
+        'sBaseline': "",
+        'fTolerance': 0.15,
+        'fMinSecs': 0.05,
+        'fMinMB': 16.0,
+        'iRepeat': 5,
+        'iObjects': 20000,
+        }
+
+STAGES = [ 'gtimage_open', 'gtimage_load', 'amplify_shades_fimg', 'resize_pwrof2square_rimg', 'hf2cm_rimg',
+            'mapto_ex_gti', 'blur_filter_rimg', 'add_noise_rimg', 'map_objects_gti', 'save_rimg' ]
+
+
+def rss_mb():
+    f = open("/proc/self/statm")
+    iPages = int(f.read().split()[1])
+    f.close()
+    return iPages*os.sysconf('SC_PAGE_SIZE')/(1024*1024)
+
+
+class RSSSampler:
+    """
+    Sample the RSS of the process periodically in a background thread, to get the peak during a stage.
+    """
+
+    def __init__(self, fPeriod=0.005):
+        self.fPeriod = fPeriod
+
+    def start(self):
+        self.fStart = rss_mb()
+        self.fPeak = self.fStart
+        self.bRun = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        while self.bRun:
+            self.fPeak = max(self.fPeak, rss_mb())
+            time.sleep(self.fPeriod)
+
+    def stop(self):
+        self.bRun = False
+        self.thread.join()
+        self.fPeak = max(self.fPeak, rss_mb())
+        return self.fPeak, self.fPeak-self.fStart
+
+
+def save_geotiff(fName, rImg, sLon, sLat, dLon, dLat):
+    """
+    Save the passed raw image (in [y, x] orientation) as a north up GeoTiff, with the given start (top left)
+    and pixel size. As in GeoTiff, a positive dLat means the latitude decreases with y.
+    """
+    info = PIL.TiffImagePlugin.ImageFileDirectory_v2()
+    info[33922] = (0.0, 0.0, 0.0, float(sLon), float(sLat), 0.0)
+    info[33550] = (float(dLon), float(dLat), 0.0)
+    PIL.Image.fromarray(rImg).save(fName, tiffinfo=info)
+
+
+def gen_heightfield(iSize, seed=0):
+    """
+    Generate a synthetic elevation image, with some hills, valleys and sea, plus noise.
+    """
+    rng = numpy.random.default_rng(seed)
+    x = numpy.linspace(0, 8*numpy.pi, iSize, dtype=numpy.float32)
+    hf = numpy.sin(x)[numpy.newaxis,:]*numpy.cos(0.7*x)[:,numpy.newaxis]*1500
+    hf += numpy.sin(0.3*x)[numpy.newaxis,:]*2000 + 1000
+    hf += rng.normal(0, 30, (iSize, iSize)).astype(numpy.float32)
+    return hf.astype(numpy.int16)
+
+
+def gen_inputs(iSize):
+    """
+    Generate the source and reference GeoTiffs and a objects db for the given size.
+    The source covers a 10x10 degree region, and the reference the whole world at 0.1 degree.
+    """
+    os.makedirs(gCfg['sWorkDir'], exist_ok=True)
+    fnSrc = os.path.join(gCfg['sWorkDir'], "src{}.tif".format(iSize))
+    if not os.path.exists(fnSrc):
+        save_geotiff(fnSrc, gen_heightfield(iSize), 60, 30, 10/iSize, 10/iSize)
+    fnRef = os.path.join(gCfg['sWorkDir'], "ref.tif")
+    if not os.path.exists(fnRef):
+        rng = numpy.random.default_rng(1)
+        rRef = rng.integers(0, 256, (1800, 3600, 3)).astype(numpy.uint8)
+        rRef[rng.random((1800, 3600)) < 0.2, :2] = 0
+        save_geotiff(fnRef, rRef, -180, 90, 0.1, 0.1)
+    rng = numpy.random.default_rng(2)
+    db = odb.initdb()
+    for lat, lon in zip(rng.uniform(-60, 70, gCfg['iObjects']), rng.uniform(-180, 180, gCfg['iObjects'])):
+        odb.set(db, lat, lon, { 'icao': "B{:05d}".format(len(db)), 'lat': str(lat), 'lon': str(lon) })
+    return fnSrc, fnRef, db
+
+
+def run_stages(iSize):
+    """
+    Run the pipeline stages in sequence for the given size, timing each of them and
+    sampling the RSS during them. Returns a dict of stage to its stats.
+    """
+    fnSrc, fnRef, db = gen_inputs(iSize)
+    # mapto's noise, blur and flip are benchmarked seperately
+    iu.gCfg['bAddNoise'] = False
+    iu.gCfg['bBlur'] = False
+    iu.gCfg['bFlip'] = False
+    imgR = iu.GTImage(fnRef, "REF")
+    fnHF = os.path.join(gCfg['sWorkDir'], "src{}.hf.png".format(iSize))
+    dStats = {}
+    dData = {}
+    dStages = {
+            'gtimage_open': lambda: iu.GTImage(fnSrc, "SRC"),
+            'gtimage_load': lambda: iu.GTImage(fnSrc, "SRC").rImg,
+            'amplify_shades_fimg': lambda: iu.amplify_shades_fimg(dData['gtimage_load'], iu.gCfg['bBoostAmplify']),
+            'resize_pwrof2square_rimg': lambda: iu.resize_pwrof2square_rimg(dData['amplify_shades_fimg'], 1, iu.gCfg['iResizeFilter']),
+            'hf2cm_rimg': lambda: iu.hf2cm_rimg(dData['resize_pwrof2square_rimg']),
+            'mapto_ex_gti': lambda: iu.mapto_ex_gti(dData['gtimage_open'], imgR),
+            'blur_filter_rimg': lambda: iu.blur_filter_rimg(dData['mapto_ex_gti'], iu.gCfg['iBlurSize'], iu.gCfg['bBlurEdges']),
+            'add_noise_rimg': lambda: iu.add_noise_rimg(dData['mapto_ex_gti'], iu.gCfg['fNoiseRatio']),
+            'map_objects_gti': lambda: iu.map_objects_gti(dData['gtimage_open'], db),
+            'save_rimg': lambda: iu.save_rimg(fnHF, dData['resize_pwrof2square_rimg'], bExpand=True),
+            }
+    for sStage in STAGES:
+        lSecs = []
+        lPeaks = []
+        lDeltas = []
+        for i in range(gCfg['iRepeat']):
+            dData.pop(sStage, None)
+            sampler = RSSSampler()
+            sampler.start()
+            tStart = time.perf_counter()
+            dData[sStage] = dStages[sStage]()
+            lSecs.append(time.perf_counter() - tStart)
+            fPeak, fDelta = sampler.stop()
+            lPeaks.append(fPeak)
+            lDeltas.append(fDelta)
+        dStats[sStage] = {
+                'secs': min(lSecs), 'secsMedian': float(numpy.median(lSecs)), 'secsSpread': max(lSecs)-min(lSecs),
+                'peakRSSMB': max(lPeaks),
+                'deltaRSSMB': float(numpy.median(lDeltas)), 'deltaRSSMBSpread': max(lDeltas)-min(lDeltas),
+                }
+        print("INFO:Bench:{}:{:26}:{:9.4f}s:Spread:{:9.4f}s:PeakRSS:{:9.1f}MB:Delta:{:9.1f}MB".format(
+            iSize, sStage, dStats[sStage]['secs'], dStats[sStage]['secsSpread'], dStats[sStage]['peakRSSMB'], dStats[sStage]['deltaRSSMB']))
+    return dStats
+
+
+def compare(dResults, dBaseline):
+    """
+    Compare the results against the baseline, and return the list of regressions.
+    A stage regresses, if its (min) time or (median) RSS delta grew by more than fTolerance (relative),
+    as well as by more than fMinSecs or fMinMB and the larger of the run to run spreads of the current
+    and baseline results (absolute, to ignore noise).
+    """
+    lRegs = []
+    for sSize in dResults:
+        for sStage in dResults[sSize]:
+            dBase = dBaseline.get(sSize, {}).get(sStage)
+            if dBase == None:
+                continue
+            dCur = dResults[sSize][sStage]
+            for k, fMinAbs in [ ('secs', gCfg['fMinSecs']), ('deltaRSSMB', gCfg['fMinMB']) ]:
+                fDiff = dCur[k] - dBase[k]
+                fSpread = max(dCur.get(k+'Spread', 0), dBase.get(k+'Spread', 0))
+                bReg = (fDiff > max(fMinAbs, fSpread)) and (dCur[k] > dBase[k]*(1+gCfg['fTolerance']))
+                sFlag = "REGRESSION" if bReg else "ok"
+                print("INFO:Compare:{}:{:26}:{:10}:{:10.4f} -> {:10.4f}:{}".format(sSize, sStage, k, dBase[k], dCur[k], sFlag))
+                if bReg:
+                    lRegs.append([sSize, sStage, k, dBase[k], dCur[k]])
+    return lRegs
+
+
+def run_main():
+    dResults = {}
+    # Each size is run in its own process, so that the RSS numbers dont depend on the earlier sizes
+    for sSize in gCfg['sSizes'].split(','):
+        pool = multiprocessing.get_context('fork').Pool(1)
+        dResults[sSize] = pool.apply(run_stages, (int(sSize),))
+        pool.close()
+        pool.join()
+    dOut = {
+            'meta': {
+                'time': time.strftime("%Y%m%d%H%M%S"),
+                'python': platform.python_version(),
+                'numpy': numpy.__version__,
+                'pil': PIL.__version__,
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                },
+            'results': dResults,
+            }
+    f = open(gCfg['sOut'], "wt")
+    json.dump(dOut, f, indent=1)
+    f.close()
+    print("INFO:Bench:Saved:{}".format(gCfg['sOut']))
+    if gCfg['sBaseline'] != "":
+        f = open(gCfg['sBaseline'])
+        dBaseline = json.load(f)['results']
+        f.close()
+        lRegs = compare(dResults, dBaseline)
+        print("INFO:Bench:Regressions:{}".format(len(lRegs)))
+        if len(lRegs) > 0:
+            exit(1)
+
+
+if __name__ == "__main__":
+    gCfg = iu.handle_args(sys.argv, gCfg)
+    run_main()
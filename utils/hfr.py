@@ -0,0 +1,77 @@
+# HFR - HeightField Raw, a simple memory mappable heightfield file format
+# HanishKVC, 2021
+# GPL
+#
+# The file contains a fixed size header followed by the raw heights.
+#   The header (little endian) is as given by HDR_DTYPE, padded to HDR_SIZE bytes.
+#   The heights are stored row after row (ie [y, x], with y=0 being the top row),
+#   either as uint16 (0 to 65535) or float32 (0.0 to 1.0), mapping the height range
+#   HMin to HMax (as in the source data) to 0.0 to 1.0.
+#   The geo bounds are NaN, if not known.
+#
+
+
+import numpy
+
+
+MAGIC = b'HKVCHFR1'
+HDR_SIZE = 128
+HDR_DTYPE = numpy.dtype([
+        ('magic', 'S8'),
+        ('xw', '<u4'),
+        ('yh', '<u4'),
+        ('dtype', '<u4'),
+        ('hdrsize', '<u4'),
+        ('slon', '<f8'),
+        ('elon', '<f8'),
+        ('slat', '<f8'),
+        ('elat', '<f8'),
+        ('hmin', '<f8'),
+        ('hmax', '<f8'),
+        ])
+DTYPES = { 1: numpy.dtype('<u2'), 2: numpy.dtype('<f4') }
+
+
+def save(fName, rImg, dGeo=None, hMin=None, hMax=None, dtype=numpy.uint16, iChunkRows=512):
+    """
+    Save the passed heightfield (in [y, x] orientation) into a hfr file.
+    dGeo if passed should contain the SLon, ELon, SLat and ELat of the heightfield.
+    The heights from hMin to hMax (default the min and max of rImg) are mapped to the full range of dtype.
+    """
+    if hMin == None:
+        hMin = float(rImg.min())
+    if hMax == None:
+        hMax = float(rImg.max())
+    if dGeo == None:
+        dGeo = { 'SLon': numpy.nan, 'ELon': numpy.nan, 'SLat': numpy.nan, 'ELat': numpy.nan }
+    iDType = 1 if numpy.dtype(dtype) == numpy.uint16 else 2
+    hdr = numpy.zeros(1, dtype=HDR_DTYPE)
+    hdr[0] = (MAGIC, rImg.shape[1], rImg.shape[0], iDType, HDR_SIZE,
+                dGeo['SLon'], dGeo['ELon'], dGeo['SLat'], dGeo['ELat'], hMin, hMax)
+    f = open(fName, "wb")
+    f.write(hdr.tobytes().ljust(HDR_SIZE, b'\0'))
+    hRange = (hMax - hMin) if (hMax != hMin) else 1
+    for iS in range(0, rImg.shape[0], iChunkRows):
+        fChunk = (rImg[iS:iS+iChunkRows] - hMin)/hRange
+        if iDType == 1:
+            fChunk = numpy.round(numpy.clip(fChunk, 0, 1)*65535)
+        f.write(fChunk.astype(DTYPES[iDType]).tobytes())
+    f.close()
+
+
+def load(fName):
+    """
+    Memory map the given hfr file.
+    Returns the header (as a dict) and the heights (as a readonly numpy.memmap in [y, x] orientation).
+    The header's scale entry gives the multiplier to map the stored heights to 0.0 to 1.0.
+    """
+    hdr = numpy.fromfile(fName, dtype=HDR_DTYPE, count=1)[0]
+    if hdr['magic'] != MAGIC:
+        raise RuntimeError("ERRR:HFR:{}: Not a hfr file".format(fName))
+    dHdr = {}
+    for k in HDR_DTYPE.names:
+        dHdr[k] = hdr[k].item()
+    dtype = DTYPES[dHdr['dtype']]
+    dHdr['scale'] = 1/65535 if dHdr['dtype'] == 1 else 1.0
+    hf = numpy.memmap(fName, dtype=dtype, mode='r', offset=dHdr['hdrsize'], shape=(dHdr['yh'], dHdr['xw']))
+    return dHdr, hf
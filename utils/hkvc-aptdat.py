@@ -2,78 +2,132 @@
 # Work on apt.dat from FlightGear/XPlane
 # HanishKVC, 2021
 # GPL
+#
+# The file is split into byte ranges at blank line (ie airport record) boundaries,
+# which are parsed in parallel and the resulting airports merged in file order.
+# Each airport record contains
+#   icao, name, elev and type (the row code of its header ie 1 airport, 16 seaplane base, 17 heliport)
+#   lat and lon, from the 1st end of its 1st land runway (only for airports ie type 1).
+#   runways: list of its land runways (row 100), each with its width, surface and
+#       ends (list of [number, lat, lon]).
+#   rows: dict of the other row codes in its record, each mapping to the list of those rows (as tokens).
+# The airports with a lat/lon are stored into data/odb.pickle (keyed by lat-lon, as before)
+# and data/odb.odbc (refer to odb.store_columnar, which keeps the duplicates).
+#
 
 
 import sys
+import os
+import multiprocessing
 
 import odb
 
 gbDebug = False
 
 
-def cleanup_line(sL):
-    la = []
-    prev = ''
-    for cur in sL:
-        if cur == ' ':
-            if prev == '':
-                continue
-            else:
-                la.append(prev)
-                prev = ''
-        else:
-            prev += cur
-    if prev != '':
-        la.append(prev)
-    return la
+def split_ranges(sFName, iParts):
+    """
+    Split the given file into upto iParts byte ranges, with each range starting just after a blank line,
+    so that no airport record is split across ranges.
+    """
+    iSize = os.path.getsize(sFName)
+    lStarts = [0]
+    f = open(sFName, "rb")
+    for i in range(1, iParts):
+        iPos = max(iSize*i//iParts, lStarts[-1])
+        f.seek(iPos)
+        if iPos > 0:
+            f.readline()
+        while True:
+            l = f.readline()
+            if (len(l) == 0) or (l.strip() == b''):
+                break
+        iPos = f.tell()
+        if iPos >= iSize:
+            break
+        if iPos > lStarts[-1]:
+            lStarts.append(iPos)
+    f.close()
+    return list(zip(lStarts, lStarts[1:]+[iSize]))
 
 
-def parse_aptdat(sFName, db):
-    f = open(sFName, errors='replace')
-    state = '0'
+def iter_airports(sFName, iStart=0, iEnd=None):
+    """
+    Generate the airport records (refer to the header) in the given byte range of the apt.dat file.
+    The file is read a line at a time, so only the current airport record is held in memory.
+    """
+    f = open(sFName, "rb")
+    f.seek(iStart)
+    iPos = iStart
     lCnt = 0
-    apt = {}
+    apt = None
     for l in f:
+        if (iEnd != None) and (iPos >= iEnd):
+            break
+        iPos += len(l)
         lCnt += 1
-        l = l.strip()
-        la = cleanup_line(l)
+        la = l.decode(errors='replace').split()
         if len(la) == 0:
-            state = '0'
-            if apt.get('lat'):
-                odb.set(db, apt['lat'], apt['lon'], apt)
-            apt = {}
+            if apt != None:
+                yield apt
+            apt = None
             continue
-        else:
-            if gbDebug:
-                print("DBUG:ParseAptDat:{}:{}".format(lCnt,la))
-        if la[0] == "1":
-            if state != '0':
-                print("ERRR:ParseAptDat:{}:New Airport Line before ending of prev airport data?".format(lCnt))
+        if gbDebug:
+            print("DBUG:ParseAptDat:{}:{}:{}".format(iStart, lCnt, la))
+        if la[0] in ("1", "16", "17"):
+            if apt != None:
+                print("ERRR:ParseAptDat:{}:{}:New Airport Line before ending of prev airport data?".format(iStart, lCnt))
                 continue
-            state = 'A'
-            apt['icao'] = la[4]
-            if gbDebug:
-                print("INFO:A:", la[4], la[5:])
-        elif (la[0] == "16") or (la[0] == "17"):
-            state = 'B'
+            apt = { 'icao': la[4], 'name': " ".join(la[5:]), 'elev': la[1], 'type': la[0], 'runways': [], 'rows': {} }
+        elif apt == None:
             continue
         elif la[0] == "100":
-            if state == 'B':
-                continue
-            if state != 'A':
-                print("ERRR:ParseAptDat:{}:Runway data in wrong place?".format(lCnt))
+            if len(la) < 20:
+                print("ERRR:ParseAptDat:{}:{}:Runway data incomplete?".format(iStart, lCnt))
                 continue
-            if gbDebug:
-                print("INFO:R:", la[9], la[10])
-            if not apt.get('lat'):
+            apt['runways'].append({ 'width': la[1], 'surface': la[2], 'ends': [ la[8:11], la[17:20] ] })
+            if (apt['type'] == "1") and (not apt.get('lat')):
                 apt['lat'] = la[9]
                 apt['lon'] = la[10]
         else:
-            continue
+            apt['rows'].setdefault(la[0], []).append(la[1:])
+    f.close()
+    if apt != None:
+        yield apt
+
+
+def parse_range(lArgs):
+    sFName, iStart, iEnd = lArgs
+    return list(iter_airports(sFName, iStart, iEnd))
+
 
+def parse_aptdat(sFName, iProcs=None):
+    """
+    Parse the given apt.dat file in parallel, and return the list of airport records, in file order.
+    """
+    if iProcs == None:
+        iProcs = os.cpu_count()
+    if iProcs == 1:
+        return list(iter_airports(sFName))
+    lRanges = split_ranges(sFName, iProcs*4)
+    print("INFO:ParseAptDat:{}:Ranges:{}:Procs:{}".format(sFName, len(lRanges), iProcs))
+    pool = multiprocessing.Pool(iProcs)
+    llApts = pool.map(parse_range, [ (sFName, iS, iE) for iS, iE in lRanges ], chunksize=1)
+    pool.close()
+    pool.join()
+    lApts = []
+    for lA in llApts:
+        lApts.extend(lA)
+    return lApts
 
-gDB = odb.initdb()
-parse_aptdat(sys.argv[1], gDB)
-print(gDB)
-odb.store(gDB, "data/odb.pickle")
 
+if __name__ == "__main__":
+    iProcs = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    lApts = parse_aptdat(sys.argv[1], iProcs)
+    lApts = [ apt for apt in lApts if apt.get('lat') ]
+    gDB = odb.initdb()
+    for apt in lApts:
+        odb.set(gDB, apt['lat'], apt['lon'], apt)
+    print("INFO:ParseAptDat:Airports:{}:Unique positions:{}".format(len(lApts), len(gDB)))
+    odb.store(gDB, "data/odb.pickle")
+    odb.store_columnar(lApts, "data/odb.odbc")
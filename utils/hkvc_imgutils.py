@@ -12,15 +12,35 @@
 # Option4: Generate Panda3D compatible heightfield and colormap images in one go.
 #   One could give a GeoTiff image containing elevation as input for example.
 # Option5: Map objects (rather airports) belonging to a given GeoTiff's region, into a text file.
+# Option6: Run one or more of the above commands on a set of images, in parallel (batch).
+#   Images whose inputs and config havent changed since their last successful run are skipped.
+# Option7: Generate a quadtree pyramid of Panda3D compatible (2^n+1 sized) heightfield and colormap tiles,
+#   along with a json manifest indexed by level/x/y.
+# Option8: Mosaic a set of GeoTiff tiles (of the same resolution) into a single GeoTiff,
+#   optionally cropped to a lon/lat box, without loading all the tiles into memory.
+# Option3 and Option4 also save the heightfield in the 16bit hfr format (refer to hfr.py), along with its geo bounds.
+# The intermediate stages can be cached across runs, by passing a cache directory (--sCacheDir <dir>).
+# Option4 can be run in a streaming mode (--bStream True), which works on strips of the image,
+#   so that large images can be handled with bounded memory. It needs a uncompressed, deflate or LZW TIFF source.
 # HanishKVC, 2021
 # GPL
 #
 
 
 import sys
+import os
+import glob
+import json
+import time
+import hashlib
+import resource
+import tempfile
+import multiprocessing
+import PIL.Image
 import numpy
 import imgutils as iu
 import odb
+import hfr
 
 
 def run_mapto():
@@ -58,23 +78,119 @@ def run_reduceshades():
 def run_p3dhf(bTranspose=False):
     iI = iu.load_rimg(gCfg['sFNameSrc'], bTranspose=bTranspose)
     iA = iu.amplify_shades_fimg(iI, gCfg['bBoostAmplify'])
-    numpy.save("/tmp/20A.npy", iA)
     iR = iu.resize_pwrof2square_rimg(iA,1, gCfg['iResizeFilter'])
-    numpy.save("/tmp/20R.npy", iR)
     fnHF = "{}.hf.png".format(gCfg['sFNameSrc'])
     iu.save_rimg(fnHF, iR, bTranspose=bTranspose, bExpand=True)
+    fnHFR = "{}.hf.hfr".format(gCfg['sFNameSrc'])
+    if bTranspose:
+        hfr.save(fnHFR, iu.transpose_rimg(iR), iu.get_geobounds(gCfg['sFNameSrc']))
+    else:
+        hfr.save(fnHFR, iR, iu.get_geobounds(gCfg['sFNameSrc']))
     return iR
 
 
 def run_hf2cm(iI=None, bTranspose=True):
     if type(iI) == type(None):
         iI = iu.load_rimg(gCfg['sFNameSrc'], bTranspose=bTranspose)
-    iC = iu.hf2cm_rimg(iI)
+    iC = iu.hf2cm_rimg(iI, dtype=numpy.uint8)
     iF = iu.flip_rimg(iC)
     fnCM = "{}.cm.png".format(gCfg['sFNameSrc'])
     iu.save_rimg(fnCM, iF, bTranspose=bTranspose)
 
 
+def run_p3dterrain_stream():
+    """
+    Generate the heightfield and colormap images (same as p3dterrain), a strip of rows at a time.
+    The 1st pass collects the global stats (max, amplify histogram) from the source,
+    the 2nd pass amplifies and resizes strips (with halo) into a temp memory mapped file,
+    the 3rd pass writes the hf.png and cm.png files incrementally from it.
+    The source needs to be readable a window at a time (refer to WindowedImage), as otherwise
+    it would be decoded fully, defeating the bounded memory, so other sources are refused.
+    """
+    iRows = gCfg['iStreamRows']
+    wI = iu.WindowedImage(gCfg['sFNameSrc'])
+    if not wI.bDirect:
+        raise RuntimeError("P3DTerrainStream:{}: Cant be read a window at a time, stream mode needs a uncompressed, deflate or LZW compressed TIFF (convert it or drop --bStream)".format(gCfg['sFNameSrc']))
+    fMax, iMult = iu.amplify_stats_wimg(wI, gCfg['bBoostAmplify'], iRows)
+    sNew = int((2**numpy.ceil(numpy.max(numpy.log2((wI.YH, wI.XW)))))+1)
+    fTmp = tempfile.TemporaryFile()
+    iR = numpy.memmap(fTmp, dtype=numpy.float32, mode='w+', shape=(sNew, sNew))
+    hfMin, hfMax = iu.amplify_resize_wimg(wI, sNew, sNew, fMax, iMult, gCfg['bBoostAmplify'], iR, gCfg['iResizeFilter'], iRows)
+    fnHF = "{}.hf.png".format(gCfg['sFNameSrc'])
+    fnCM = "{}.cm.png".format(gCfg['sFNameSrc'])
+    print("imgutils:SavingStream:", fnHF, fnCM, iR.shape, hfMin, hfMax)
+    pwHF = iu.PngStripWriter(fnHF, sNew, sNew)
+    for o0 in range(0, sNew, iRows):
+        pwHF.write_rows(iu.to_uint8(iR[o0:o0+iRows], hfMin, hfMax))
+    pwHF.close()
+    fnHFR = "{}.hf.hfr".format(gCfg['sFNameSrc'])
+    hfr.save(fnHFR, iR, iu.get_geobounds(gCfg['sFNameSrc']), hfMin, hfMax, iChunkRows=iRows)
+    # The colormap is flipped vertically wrt the heightfield
+    pwCM = iu.PngStripWriter(fnCM, sNew, sNew, 3)
+    for o1 in range(sNew, 0, -iRows):
+        pwCM.write_rows(iu.hf2cm_rimg(iR[max(o1-iRows,0):o1][::-1], dtype=numpy.uint8))
+    pwCM.close()
+    del(iR)
+    fTmp.close()
+    print("INFO:P3DTerrainStream:PeakRSS:{:.1f}MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
+
+
+def run_p3dpyramid():
+    """
+    Generate a quadtree pyramid of heightfield and colormap tiles from the source image.
+    Each level is resized from the amplified source, and cut into iTileSize (2^n+1) sized tiles,
+    with neighbouring tiles sharing their borders. Level 0 is a single tile covering the full
+    image, with each level doubling the number of tiles along x and y, till the finest level
+    matches or exceeds the source resolution (or iPyramidLevels levels).
+    The tiles are stored under <src>.pyramid/L<level>/<x>_<y>.[hf.png|hf.hfr|cm.png], with
+    manifest.json mapping "level/x/y" to the tile files and their geo bounds.
+    All heightfield tiles use the same height range, so heights match across tiles and levels.
+    """
+    iTileSize = gCfg.get('iTileSize', 257)
+    iI = iu.load_rimg(gCfg['sFNameSrc'])
+    iA = iu.amplify_shades_fimg(iI, gCfg['bBoostAmplify'])
+    del(iI)
+    hMin, hMax = float(iA.min()), float(iA.max())
+    dGeo = iu.get_geobounds(gCfg['sFNameSrc'])
+    iLevels = iu.pyramid_levels(iA.shape[1], iA.shape[0], iTileSize, gCfg.get('iPyramidLevels', -1))
+    sDir = "{}.pyramid".format(gCfg['sFNameSrc'])
+    manifest = {
+            'src': os.path.basename(gCfg['sFNameSrc']),
+            'tileSize': iTileSize,
+            'levels': iLevels,
+            'hMin': hMin,
+            'hMax': hMax,
+            'geo': dGeo,
+            'tiles': {},
+            }
+    for iLevel in range(iLevels):
+        sLDir = os.path.join(sDir, "L{}".format(iLevel))
+        os.makedirs(sLDir, exist_ok=True)
+        iSize = (iTileSize-1)*2**iLevel+1
+        print("INFO:P3DPyramid:Level:{}:{}x{}".format(iLevel, iSize, iSize))
+        iL = iu.resize_rimg(iA, iSize, iSize, gCfg['iResizeFilter'])
+        for tx, ty, iT in iu.pyramid_tiles_rimg(iL, iTileSize):
+            sBase = "L{}/{}_{}".format(iLevel, tx, ty)
+            dTile = { 'hf': sBase+".hf.png", 'hfr': sBase+".hf.hfr", 'cm': sBase+".cm.png" }
+            if dGeo != None:
+                fLonPP = (dGeo['ELon']-dGeo['SLon'])/(iSize-1)
+                fLatPP = (dGeo['ELat']-dGeo['SLat'])/(iSize-1)
+                dTile['geo'] = {
+                        'SLon': dGeo['SLon']+tx*(iTileSize-1)*fLonPP,
+                        'ELon': dGeo['SLon']+(tx+1)*(iTileSize-1)*fLonPP,
+                        'SLat': dGeo['SLat']+ty*(iTileSize-1)*fLatPP,
+                        'ELat': dGeo['SLat']+(ty+1)*(iTileSize-1)*fLatPP,
+                        }
+            PIL.Image.fromarray(iu.to_uint8(iT, hMin, hMax)).save(os.path.join(sDir, dTile['hf']))
+            hfr.save(os.path.join(sDir, dTile['hfr']), iT, dTile.get('geo'), hMin, hMax)
+            # The colormap is flipped vertically wrt the heightfield
+            PIL.Image.fromarray(iu.hf2cm_rimg(iT, dtype=numpy.uint8)[::-1]).save(os.path.join(sDir, dTile['cm']))
+            manifest['tiles']["{}/{}/{}".format(iLevel, tx, ty)] = dTile
+    f = open(os.path.join(sDir, "manifest.json"), "wt")
+    json.dump(manifest, f, indent=1)
+    f.close()
+
+
 def run_lcrop():
     iI = iu.load_rimg(gCfg['sFNameSrc'], bTranspose=gCfg['bTranspose'])
     xS = gCfg['iXS']
@@ -86,36 +202,175 @@ def run_lcrop():
     iu.save_rimg(fnC, iC, bTranspose=gCfg['bTranspose'])
 
 
+def run_cmd(sCmd):
+    if sCmd == "mapto":
+        run_mapto()
+    elif sCmd == "mapobjects":
+        run_mapobjects()
+    elif sCmd == "reduceshades":
+        run_reduceshades()
+    elif sCmd == "p3dhf":
+        run_p3dhf()
+    elif sCmd == "hf2cm":
+        run_hf2cm()
+    elif sCmd == "p3dterrain":
+        if gCfg['bStream']:
+            run_p3dterrain_stream()
+        else:
+            iR = run_p3dhf(True)
+            run_hf2cm(iR, True)
+    elif sCmd == "p3dpyramid":
+        run_p3dpyramid()
+    elif sCmd == "lcrop":
+        run_lcrop()
+    else:
+        raise RuntimeError("UnKnown Command:{}".format(sCmd))
+
+
+# The files (other than sFNameSrc) which a command depends on, and the files it generates.
+gBatchInputs = { 'mapto': [ 'sFNameRef' ], 'mapobjects': [ 'sFNameODB' ] }
+gBatchOutputs = {
+        'p3dterrain': [ "{}.hf.png", "{}.hf.hfr", "{}.cm.png" ],
+        'mapto': [ "{}.cm.png" ],
+        'mapobjects': [ "{}.objects" ],
+        'p3dpyramid': [ "{}.pyramid/manifest.json" ],
+        }
+# The config entries which dont affect the outputs of a command.
+gBatchCfgSkip = [ 'sCmd', 'sFNameSrc', 'sBatchSrc', 'sBatchCmds', 'iBatchProcs', 'bBreakPoint', 'bDebug', 'sCacheDir', 'iCacheMaxMB' ]
+
+
+def batch_stamp(sCmd):
+    """
+    Get the content hash of the inputs and config, wrt the given command on the current sFNameSrc.
+    """
+    h = hashlib.sha256()
+    h.update(sCmd.encode())
+    h.update(iu.hash_file(gCfg['sFNameSrc']).encode())
+    for k in gBatchInputs.get(sCmd, []):
+        h.update(iu.hash_file(gCfg[k]).encode())
+    dCfg = {}
+    for k in gCfg:
+        if k not in gBatchCfgSkip:
+            dCfg[k] = gCfg[k]
+    h.update(json.dumps(dCfg, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def batch_worker(cfg):
+    """
+    Run the batch commands on the sFNameSrc in the passed cfg.
+    Returns the list of [sFNameSrc, sCmd, sStatus, fSecs] wrt each command.
+    """
+    global gCfg
+    gCfg = iu.init(cfg)
+    lStats = []
+    for sCmd in gCfg['sBatchCmds'].split(','):
+        tStart = time.time()
+        fnStamp = "{}.{}.stamp".format(gCfg['sFNameSrc'], sCmd)
+        try:
+            sStamp = batch_stamp(sCmd)
+            bUpToDate = os.path.exists(fnStamp) and (open(fnStamp).read() == sStamp)
+            for sOut in gBatchOutputs.get(sCmd, []):
+                if not os.path.exists(sOut.format(gCfg['sFNameSrc'])):
+                    bUpToDate = False
+            if bUpToDate:
+                sStatus = "skipped"
+            else:
+                run_cmd(sCmd)
+                f = open(fnStamp, "wt")
+                f.write(sStamp)
+                f.close()
+                sStatus = "built"
+        except:
+            print("ERRR:Batch:{}:{}:{}".format(gCfg['sFNameSrc'], sCmd, sys.exc_info()))
+            sStatus = "failed"
+        lStats.append([gCfg['sFNameSrc'], sCmd, sStatus, time.time()-tStart])
+    return lStats
+
+
+def list_images(sSrc):
+    """
+    Get the sorted list of images in sSrc, which could be a directory (wrt its .tif/.tiff files) or a glob pattern.
+    """
+    if os.path.isdir(sSrc):
+        lFiles = glob.glob(os.path.join(sSrc, "*.tif")) + glob.glob(os.path.join(sSrc, "*.tiff"))
+    else:
+        lFiles = glob.glob(sSrc)
+    lFiles.sort()
+    return lFiles
+
+
+def run_mosaic():
+    """
+    Mosaic the GeoTiffs in sMosaicSrc (a directory or glob pattern) into a single GeoTiff (sFNameMosaic),
+    optionally cropped to the lon/lat box in sMosaicBox (lon0,lat0,lon1,lat1).
+    Only the tags of the source images are parsed upfront, with their pixels copied in a strip at a time.
+    """
+    lFiles = list_images(gCfg['sMosaicSrc'])
+    if len(lFiles) == 0:
+        raise RuntimeError("Mosaic: No images in {}".format(gCfg['sMosaicSrc']))
+    lImgs = []
+    for sFile in lFiles:
+        img = iu.GTImage(sFile, os.path.basename(sFile))
+        img.print_info()
+        lImgs.append(img)
+    lBox = None
+    if gCfg.get('sMosaicBox', "") != "":
+        lBox = [ float(v) for v in gCfg['sMosaicBox'].split(',') ]
+    sOut = gCfg.get('sFNameMosaic', "mosaic.tif")
+    dGeo = iu.mosaic_gtis(lImgs, sOut, lBox, gCfg['iStreamRows'])
+    print("INFO:Mosaic:Saved:{}:{}".format(sOut, dGeo))
+
+
+def run_batch():
+    """
+    Run the commands in sBatchCmds (comma seperated) on each of the images in sBatchSrc,
+    which could be a directory (wrt its .tif/.tiff files) or a glob pattern.
+    The images are handled in parallel, using iBatchProcs processes (defaults to the number of cores).
+    """
+    lFiles = list_images(gCfg['sBatchSrc'])
+    gCfg['sBatchCmds'] = gCfg.get('sBatchCmds', "p3dterrain")
+    iProcs = gCfg.get('iBatchProcs', os.cpu_count())
+    print("INFO:Batch:{} files:{}:Procs:{}".format(len(lFiles), gCfg['sBatchCmds'], iProcs))
+    lCfgs = []
+    for sFile in lFiles:
+        cfg = dict(gCfg)
+        cfg['sFNameSrc'] = sFile
+        lCfgs.append(cfg)
+    tStart = time.time()
+    pool = multiprocessing.Pool(iProcs)
+    lResults = pool.map(batch_worker, lCfgs, chunksize=1)
+    pool.close()
+    pool.join()
+    print("INFO:Batch:Summary")
+    for lStats in lResults:
+        for sFile, sCmd, sStatus, fSecs in lStats:
+            print("\t{:10.2f}s:{:8}:{:12}:{}".format(fSecs, sStatus, sCmd, sFile))
+    print("INFO:Batch:Done:{:.2f}s".format(time.time()-tStart))
+
+
 def run_main():
     if type(gCfg.get('bBreakPoint')) != type(None):
         breakpoint()
     try:
-        if gCfg['sCmd'] == "mapto":
-            run_mapto()
-        elif gCfg['sCmd'] == "mapobjects":
-            run_mapobjects()
-        elif gCfg['sCmd'] == "reduceshades":
-            run_reduceshades()
-        elif gCfg['sCmd'] == "p3dhf":
-            run_p3dhf()
-        elif gCfg['sCmd'] == "hf2cm":
-            run_hf2cm()
-        elif gCfg['sCmd'] == "p3dterrain":
-            iR = run_p3dhf(True)
-            run_hf2cm(iR, True)
-        elif gCfg['sCmd'] == "lcrop":
-            run_lcrop()
+        if gCfg['sCmd'] == "batch":
+            run_batch()
+        elif gCfg['sCmd'] == "mosaic":
+            run_mosaic()
         else:
-            raise RuntimeError("UnKnown Command:{}".format(gCfg['sCmd']))
+            run_cmd(gCfg['sCmd'])
     except:
         print(sys.exc_info())
         print("thisPrg --sCmd mapto --sFNameSrc <srcImage> --sFNameRef <refImage>")
         print("thisPrg --sCmd reduceshades --sFNameSrc <srcImage>")
         print("thisPrg --sCmd p3dhf --sFNameSrc <srcImage>")
         print("thisPrg --sCmd hf2cm --sFNameSrc <srcImage>")
-        print("thisPrg --sCmd p3dterrain --sFNameSrc <srcImage>")
+        print("thisPrg --sCmd p3dterrain --sFNameSrc <srcImage> [--bStream True [--iStreamRows <int>]]")
+        print("thisPrg --sCmd p3dpyramid --sFNameSrc <srcImage> [--iTileSize <2^n+1>] [--iPyramidLevels <int>]")
         print("thisPrg --sCmd lcrop --sFNameSrc <srcImage> --iXS <int> --iYS <int> --iXE <int> --iYE <int>")
         print("thisPrg --sCmd mapobjects --sFNameSrc <srcImage> --sFNameODB <odb.pickle>")
+        print("thisPrg --sCmd mosaic --sMosaicSrc <dir|glob> [--sMosaicBox <lon0,lat0,lon1,lat1>] [--sFNameMosaic <out.tif>]")
+        print("thisPrg --sCmd batch --sBatchSrc <dir|glob> [--sBatchCmds <cmd1,cmd2,...>] [--iBatchProcs <int>] <args needed by the cmds>")
 
 
 if __name__ == "__main__":
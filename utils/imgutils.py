@@ -5,6 +5,12 @@
 # GPL
 
 
+import os
+import glob
+import json
+import zlib
+import hashlib
+import struct
 import PIL.Image
 import numpy
 import PIL.PngImagePlugin
@@ -24,31 +30,79 @@ gCfg = {
         'bFlip': True,
         'bFlipVert': True,
         'iResizeFilter': PIL.Image.BILINEAR,
+        'sCMRamp': 'default',
+        'bStream': False,
+        'iStreamRows': 512,
+        'sCacheDir': '',
+        'iCacheMaxMB': 4096,
+        }
+
+
+# The ColorMap ramps used by hf2cm_rimg.
+# gCfg['sCMRamp'] selects one of these by name, or else can point to a json file
+# containing a list of bands in the same format.
+# Each band is [ fUpTo, [R, G, B], fShadeBase, fShadeRange ]
+#   It covers heights from the previous band's fUpTo to its own fUpTo.
+#   Its color is scaled by a shade, which moves linearly from fShadeBase
+#   to fShadeBase+fShadeRange across the band.
+#   The 1st band includes its fUpTo and has no lower limit, so only fShadeBase is used.
+#   The last band takes all heights beyond the previous band.
+gCMRamps = {
+        'default': [
+            [ 0.0, [0, 0, 1], 1.0, 0.0 ],
+            [ 0.2, [0, 1, 0], 0.2, 0.8 ],
+            [ 0.4, [0.5, 0.25, 0], 0.2, 0.8 ],
+            [ 1.0, [1, 1, 1], 0.2, 0.8 ],
+            ],
         }
 
 
 class GTImage:
+    """
+    A GeoTiff image. The tags and the geo transform are parsed when created,
+    while the pixels are decoded only when rImg is first accessed (or load is called).
+    Windows of the image can be read by pixel or lon/lat box, without decoding all of it.
+    """
 
-    def __init__(self, fName, tag, debug=None):
+    def __init__(self, fName, tag, debug=None, bLoad=False):
         self.fName = fName
         self.tag = tag
         if debug == None:
             debug = gCfg['bDebug']
         self.debug = debug
-        self.load()
+        self._rImg = None
+        self.wImg = None
+        self.pImg = PIL.Image.open(self.fName)
+        if bLoad:
+            self.load()
         self.parse_geotiff()
 
+    @property
+    def rImg(self):
+        if type(self._rImg) == type(None):
+            self.load()
+        return self._rImg
+
+    @rImg.setter
+    def rImg(self, rImg):
+        self._rImg = rImg
+
     def print_info(self):
         print("{}:Lon".format(self.tag), self.sLon, self.dLon, self.eLon, self.XW)
         print("{}:Lat".format(self.tag), self.sLat, self.dLat, self.eLat, self.YH)
-        print("{}:dim:{}:dtype:{}:min:{}:max:{}".format(self.tag, self.rImg.shape, self.rImg.dtype, self.rImg.min(), self.rImg.max()))
+        if type(self._rImg) == type(None):
+            print("{}:dim:{}:mode:{}:NotLoaded".format(self.tag, (self.XW, self.YH), self.pImg.mode))
+        else:
+            print("{}:dim:{}:dtype:{}:min:{}:max:{}".format(self.tag, self._rImg.shape, self._rImg.dtype, self._rImg.min(), self._rImg.max()))
+
+    def get_geobounds(self):
+        return { 'SLon': self.sLon, 'ELon': self.eLon, 'SLat': self.sLat, 'ELat': self.eLat }
 
     def get_pnginfo(self):
         info = PIL.PngImagePlugin.PngInfo()
-        info.add_text("SLon", str(self.sLon))
-        info.add_text("ELon", str(self.eLon))
-        info.add_text("SLat", str(self.sLat))
-        info.add_text("ELat", str(self.eLat))
+        dGeo = self.get_geobounds()
+        for k in dGeo:
+            info.add_text(k, str(dGeo[k]))
         return info
 
     def load(self, fName=None, bTranspose=True):
@@ -56,6 +110,7 @@ class GTImage:
             fName = self.fName
         else:
             self.fName = fName
+            self.wImg = None
         self.pImg = PIL.Image.open(self.fName)
         try:
             if self.pImg.mode == 'P':
@@ -67,6 +122,46 @@ class GTImage:
         except RuntimeError:
             raise RuntimeError("{}: Image neither Gray or RGB".format(self.fName))
 
+    def read_xy(self, x0, y0, x1, y1):
+        """
+        Read the window covering pixels x0 to x1-1 and y0 to y1-1, in the same [x, y(, band)]
+        orientation as rImg. Only the strips/tiles covering the window are decoded, if rImg isnt loaded.
+        """
+        if type(self._rImg) != type(None):
+            return self._rImg[x0:x1, y0:y1]
+        if self.wImg == None:
+            self.wImg = WindowedImage(self.fName, self.pImg)
+        rWin = self.wImg.read(x0, y0, x1, y1)
+        if self.pImg.mode == 'P':
+            rPal = numpy.array(self.pImg.getpalette(), dtype=numpy.uint8).reshape(-1, 3)
+            rWin = rPal[rWin]
+        return transpose_rimg(rWin)
+
+    def read_coord(self, lon0, lat0, lon1, lat1):
+        """
+        Read the window covering the given lon/lat box (clipped to the image).
+        Returns the window (as in read_xy) and the x, y of its top left pixel, or None if the box is outside the image.
+        """
+        x, y = self.ll2xy_box(lon0, lat0, lon1, lat1)
+        if x == None:
+            return None
+        return self.read_xy(x[0], y[0], x[1], y[1]), x[0], y[0]
+
+    def ll2xy_box(self, lon0, lat0, lon1, lat1):
+        """
+        Map the given lon/lat box to the pixel box [x0, x1), [y0, y1) covering it, clipped to the image.
+        Returns (None, None) if the box is outside the image.
+        """
+        fX = (numpy.array([lon0, lon1]) - self.sLon)/self.dLon
+        fY = (numpy.array([lat0, lat1]) - self.sLat)/self.dLat
+        x0 = max(int(numpy.floor(fX.min())), 0)
+        x1 = min(int(numpy.ceil(fX.max()))+1, self.XW)
+        y0 = max(int(numpy.floor(fY.min())), 0)
+        y1 = min(int(numpy.ceil(fY.max()))+1, self.YH)
+        if (x0 >= x1) or (y0 >= y1):
+            return None, None
+        return (x0, x1), (y0, y1)
+
     def save(self, fName=None, rImg2Save=None, bTranspose=True):
         if fName == None:
             fName = self.fName
@@ -141,14 +236,478 @@ class GTImage:
         x,y = self.coord2xy(lon, lat)
         return self.getpixel_xy(x,y)
 
+    def xy2coord_arr(self, x, y):
+        """
+        Vectorised xy2coord, which maps numpy arrays of x and y into lon and lat arrays,
+        using the xy2llTrans geotransform.
+        As the geotransform is limited to scaling and translation, lon only depends on x
+        and lat only on y. So one can pass a column of x and a row of y, to get the lon
+        and lat wrt the full grid, through numpy broadcasting.
+        """
+        lon = self.xy2llTrans[0,3] + self.xy2llTrans[0,0]*x
+        lat = self.xy2llTrans[1,3] + self.xy2llTrans[1,1]*y
+        return lon, lat
+
+    def coord2xy_arr(self, lon, lat):
+        """
+        Vectorised coord2xy, which maps numpy arrays of lon and lat into x and y arrays,
+        using the xy2llTrans geotransform (so that the rounding matches coord2xy).
+        It returns x, y and a mask which tells which of the (broadcasted) lon,lat pairs
+        fall within the image. The x and y of the ones outside the image are set to 0.
+        """
+        x = numpy.round((lon - self.xy2llTrans[0,3])/self.xy2llTrans[0,0]).astype(numpy.int64)
+        y = numpy.round((lat - self.xy2llTrans[1,3])/self.xy2llTrans[1,1]).astype(numpy.int64)
+        bXOk = (lon >= self.sLon) & (lon <= self.eLon) & (x < self.XW)
+        bYOk = (lat <= self.sLat) & (lat >= self.eLat) & (y < self.YH)
+        x[~bXOk] = 0
+        y[~bYOk] = 0
+        return x, y, bXOk & bYOk
+
+
+def cache_enabled():
+    return gCfg['sCacheDir'] != ''
+
+
+def hash_rimg(rImg, iChunkRows=256):
+    """
+    Return the sha256 hexdigest of the passed raw image's shape, dtype and contents.
+    """
+    h = hashlib.sha256()
+    h.update("{}:{}".format(rImg.shape, rImg.dtype.str).encode())
+    for iS in range(0, rImg.shape[0], iChunkRows):
+        h.update(numpy.ascontiguousarray(rImg[iS:iS+iChunkRows]).data)
+    return h.hexdigest()
+
+
+def cache_key(sStage, *lParts):
+    """
+    Build the cache key for the given stage, from the passed parts, which are expected to be
+    content hashes of the inputs (refer to hash_file and hash_rimg) and the stage's parameters.
+    """
+    h = hashlib.sha256()
+    h.update(sStage.encode())
+    for p in lParts:
+        h.update(":{}".format(p).encode())
+    return "{}-{}".format(sStage, h.hexdigest())
+
+
+def cache_get(sKey):
+    """
+    Return the cached raw image with the given key (as a readonly memory mapped array), if any.
+    The entry is marked as recently used.
+    """
+    if sKey == None:
+        return None
+    fName = os.path.join(gCfg['sCacheDir'], "{}.npy".format(sKey))
+    if not os.path.exists(fName):
+        return None
+    os.utime(fName)
+    print("\tCacheHit", sKey)
+    return numpy.load(fName, mmap_mode='r')
+
+
+def cache_put(sKey, rImg):
+    """
+    Store the raw image into the cache with the given key, if caching is enabled
+    (ie gCfg['sCacheDir'] is set). Inturn evict the least recently used entries,
+    so that the cache stays within gCfg['iCacheMaxMB'].
+    """
+    if sKey == None:
+        return
+    os.makedirs(gCfg['sCacheDir'], exist_ok=True)
+    fName = os.path.join(gCfg['sCacheDir'], "{}.npy".format(sKey))
+    fTmp = "{}.{}.tmp".format(fName, os.getpid())
+    f = open(fTmp, "wb")
+    numpy.save(f, rImg)
+    f.close()
+    os.replace(fTmp, fName)
+    lEntries = []
+    iTotal = 0
+    for fEntry in glob.glob(os.path.join(gCfg['sCacheDir'], "*.npy")):
+        st = os.stat(fEntry)
+        lEntries.append((st.st_mtime, st.st_size, fEntry))
+        iTotal += st.st_size
+    lEntries.sort()
+    for fMTime, iSize, fEntry in lEntries:
+        if iTotal <= gCfg['iCacheMaxMB']*1024*1024:
+            break
+        print("\tCacheEvict", fEntry)
+        os.remove(fEntry)
+        iTotal -= iSize
+
+
+def tiff_lzw_decode(data):
+    """
+    Decode the passed TIFF LZW (ie MSB first codes, with early change) compressed strip or tile.
+    PIL decodes LZW tiffs only through libtiff, which works on the whole image, hence this.
+    """
+    if data[:1] != b'\x80':
+        raise RuntimeError("imgutils:TiffLZW: Doesnt start with a clear code, old style LZW is not supported")
+    out = bytearray()
+    lTable = [ bytes([i]) for i in range(256) ] + [ b'', b'' ]
+    iBits = 9
+    iMask = (1<<iBits)-1
+    iBuf = 0
+    iBufBits = 0
+    prev = None
+    for b in data:
+        iBuf = (iBuf << 8) | b
+        iBufBits += 8
+        if iBufBits < iBits:
+            continue
+        iBufBits -= iBits
+        code = (iBuf >> iBufBits) & iMask
+        iBuf &= (1<<iBufBits)-1
+        if code == 256:
+            del(lTable[258:])
+            iBits = 9
+            iMask = (1<<iBits)-1
+            prev = None
+            continue
+        if code == 257:
+            break
+        if prev == None:
+            entry = lTable[code]
+        elif code < len(lTable):
+            entry = lTable[code]
+            lTable.append(prev + entry[:1])
+        else:
+            entry = prev + prev[:1]
+            lTable.append(entry)
+        out += entry
+        prev = entry
+        if (len(lTable)+1 >= (1<<iBits)) and (iBits < 12):
+            iBits += 1
+            iMask = (1<<iBits)-1
+    return bytes(out)
+
+
+class WindowedImage:
+    """
+    Read rectangular windows of a image, without decoding all of it, where possible.
+
+    Uncompressed, deflate or LZW compressed TIFF images (with or without horizontal predictor)
+    are handled directly, by reading and decoding only the strips or tiles which overlap
+    the requested window.
+    Other images are decoded fully by PIL on the first read, and windows are cut from it.
+
+    The windows are returned in PIL orientation, ie [y, x] or [y, x, band].
+    """
+
+    def __init__(self, fName, pImg=None):
+        self.fName = fName
+        if pImg == None:
+            pImg = PIL.Image.open(fName)
+        self.pImg = pImg
+        self.XW, self.YH = pImg.size
+        self.rFull = None
+        self.bDirect = self._setup_tiff()
+
+    def _setup_tiff(self):
+        if self.pImg.format != 'TIFF':
+            return False
+        tags = self.pImg.tag_v2
+        if tags.get(259, 1) not in (1, 5, 8, 32946):
+            return False
+        if (tags.get(284, 1) != 1) or (tags.get(317, 1) not in (1, 2)):
+            return False
+        lBits = numpy.atleast_1d(tags.get(258, 1))
+        lFmts = numpy.atleast_1d(tags.get(339, 1))
+        if (len(set(lBits)) != 1) or (len(set(lFmts)) != 1):
+            return False
+        iBits = int(lBits[0])
+        sKind = { 1: 'u', 2: 'i', 3: 'f' }.get(int(lFmts[0]))
+        if (sKind == None) or (iBits not in (8, 16, 32, 64)):
+            return False
+        f = open(self.fName, "rb")
+        sEndian = '<' if f.read(2) == b'II' else '>'
+        f.close()
+        self.fileDType = numpy.dtype("{}{}{}".format(sEndian, sKind, iBits//8))
+        self.dtype = self.fileDType.newbyteorder('=')
+        self.iBands = int(tags.get(277, 1))
+        self.iCompression = tags.get(259, 1)
+        self.bPredictor = (tags.get(317, 1) == 2)
+        if tags.get(322) != None:
+            self.iTW, self.iTH = int(tags[322]), int(tags[323])
+            self.lOffsets = numpy.atleast_1d(tags[324])
+            self.lCounts = numpy.atleast_1d(tags[325])
+        else:
+            self.iTW, self.iTH = self.XW, int(tags.get(278, self.YH))
+            self.lOffsets = numpy.atleast_1d(tags[273])
+            self.lCounts = numpy.atleast_1d(tags[279])
+        self.iTilesAcross = -(-self.XW//self.iTW)
+        return True
+
+    def _read_tile(self, f, iTile):
+        f.seek(int(self.lOffsets[iTile]))
+        data = f.read(int(self.lCounts[iTile]))
+        if self.iCompression == 5:
+            data = tiff_lzw_decode(data)
+        elif self.iCompression != 1:
+            data = zlib.decompress(data)
+        tImg = numpy.frombuffer(data, dtype=self.fileDType)
+        tImg = tImg[:(len(tImg)//(self.iTW*self.iBands))*self.iTW*self.iBands]
+        tImg = tImg.reshape(-1, self.iTW, self.iBands)
+        if self.bPredictor:
+            tImg = numpy.cumsum(tImg, axis=1, dtype=self.fileDType)
+        return tImg.astype(self.dtype)
+
+    def read(self, x0, y0, x1, y1):
+        """
+        Read the window covering pixels x0 to x1-1 and y0 to y1-1.
+        """
+        if not self.bDirect:
+            if type(self.rFull) == type(None):
+                print("WARN:WindowedImage:{}:Decoding full image".format(self.fName))
+                self.rFull = numpy.array(self.pImg)
+            return self.rFull[y0:y1, x0:x1]
+        rWin = numpy.empty((y1-y0, x1-x0, self.iBands), dtype=self.dtype)
+        f = open(self.fName, "rb")
+        for ty in range(y0//self.iTH, (y1-1)//self.iTH+1):
+            for tx in range(x0//self.iTW, (x1-1)//self.iTW+1):
+                tImg = self._read_tile(f, ty*self.iTilesAcross+tx)
+                tY0, tX0 = ty*self.iTH, tx*self.iTW
+                sY0, sY1 = max(y0, tY0), min(y1, tY0+tImg.shape[0])
+                sX0, sX1 = max(x0, tX0), min(x1, tX0+self.iTW)
+                rWin[sY0-y0:sY1-y0, sX0-x0:sX1-x0] = tImg[sY0-tY0:sY1-tY0, sX0-tX0:sX1-tX0]
+        f.close()
+        if self.iBands == 1:
+            rWin = rWin[:,:,0]
+        return rWin
+
+    def rows(self, iRows, iHalo=0):
+        """
+        Iterate through the image, in strips of iRows rows, with iHalo rows of overlap
+        on either side (where available). Returns (y0, y1, yS, strip) for each strip,
+        where the strip covers rows yS onwards, which includes the rows y0 to y1-1.
+        """
+        for y0 in range(0, self.YH, iRows):
+            y1 = min(y0+iRows, self.YH)
+            yS = max(y0-iHalo, 0)
+            yE = min(y1+iHalo, self.YH)
+            yield y0, y1, yS, self.read(0, yS, self.XW, yE)
+
+
+class PngStripWriter:
+    """
+    Write a 8bit gray or rgb png file, a strip of rows at a time, so that the full
+    image need not be in memory.
+    """
+
+    def __init__(self, fName, xW, yH, iBands=1, dTexts=None):
+        self.fName = fName
+        self.xW = xW
+        self.yH = yH
+        self.iBands = iBands
+        self.iRowsDone = 0
+        self.f = open(fName, "wb")
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        colorType = 0 if iBands == 1 else 2
+        self._chunk(b'IHDR', struct.pack(">IIBBBBB", xW, yH, 8, colorType, 0, 0, 0))
+        if dTexts != None:
+            for k in dTexts:
+                self._chunk(b'tEXt', "{}\0{}".format(k, dTexts[k]).encode('latin-1'))
+        self.zc = zlib.compressobj()
+
+    def _chunk(self, cType, data):
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(cType)
+        self.f.write(data)
+        self.f.write(struct.pack(">I", zlib.crc32(cType+data)))
+
+    def write_rows(self, rImg):
+        """
+        Write the passed uint8 rows (in PIL orientation ie [y, x] or [y, x, band]).
+        """
+        iRows = rImg.shape[0]
+        raw = numpy.zeros((iRows, 1+self.xW*self.iBands), dtype=numpy.uint8)
+        raw[:,1:] = rImg.reshape(iRows, -1)
+        data = self.zc.compress(raw.tobytes())
+        if len(data) > 0:
+            self._chunk(b'IDAT', data)
+        self.iRowsDone += iRows
+
+    def close(self):
+        self._chunk(b'IDAT', self.zc.flush())
+        self._chunk(b'IEND', b'')
+        self.f.close()
+        if self.iRowsDone != self.yH:
+            raise RuntimeError("imgutils:PngStripWriter:{}: Wrote {} rows of {}".format(self.fName, self.iRowsDone, self.yH))
+
+
+def geotiff_memmap(fName, xW, yH, dtype, iBands=1, dGeo=None, iStripRows=64):
+    """
+    Create a uncompressed GeoTiff file of the given size and dtype, with its pixels (initially zero) memory mapped.
+    dGeo if passed should contain the SLon, SLat, DLon and DLat (the pixel size, negative for north up) of the image.
+    The pixels are stored contiguously after the header, in strips of iStripRows rows, so that
+    WindowedImage can read parts of it directly.
+    Returns the pixels as a numpy.memmap in [y, x] or [y, x, band] orientation.
+    """
+    dtype = numpy.dtype(dtype).newbyteorder('<')
+    iBytes = xW*yH*iBands*dtype.itemsize
+    iStrips = -(-yH//iStripRows)
+    iStripBytes = xW*iStripRows*iBands*dtype.itemsize
+    sFmt = { 'u': 1, 'i': 2, 'f': 3 }[dtype.kind]
+    lTags = [
+            [ 256, 4, [xW] ],
+            [ 257, 4, [yH] ],
+            [ 258, 3, [dtype.itemsize*8]*iBands ],
+            [ 259, 3, [1] ],
+            [ 262, 3, [1 if iBands == 1 else 2] ],
+            [ 273, 4, None ],
+            [ 277, 3, [iBands] ],
+            [ 278, 4, [iStripRows] ],
+            [ 279, 4, [min(iStripBytes, iBytes-i*iStripBytes) for i in range(iStrips)] ],
+            [ 284, 3, [1] ],
+            [ 339, 3, [sFmt]*iBands ],
+            ]
+    if dGeo != None:
+        lTags.append([ 33550, 12, [dGeo['DLon'], -dGeo['DLat'], 0.0] ])
+        lTags.append([ 33922, 12, [0.0, 0.0, 0.0, dGeo['SLon'], dGeo['SLat'], 0.0] ])
+        lTags.append([ 34737, 2, "WGS 84|" ])
+    dTypeFmt = { 2: 'c', 3: 'H', 4: 'I', 12: 'd' }
+    # Work out where the out of line tag values go, followed by the pixels
+    iIFDSize = 2 + len(lTags)*12 + 4
+    iPos = 8 + iIFDSize
+    lValues = []
+    for lTag in lTags:
+        if lTag[0] == 273:
+            lTag[2] = [0]*iStrips
+        bValue = lTag[2].encode()+b'\0' if lTag[1] == 2 else struct.pack("<{}{}".format(len(lTag[2]), dTypeFmt[lTag[1]]), *lTag[2])
+        lValues.append(bValue)
+    for i in range(len(lTags)):
+        if len(lValues[i]) > 4:
+            iPos += len(lValues[i]) + (len(lValues[i]) % 2)
+    iData = iPos
+    if iData+iBytes >= 2**32:
+        raise RuntimeError("imgutils:GeoTiffMemMap:{}: Too large for a classic tiff".format(fName))
+    for i in range(len(lTags)):
+        if lTags[i][0] == 273:
+            lValues[i] = struct.pack("<{}I".format(iStrips), *[iData+j*iStripBytes for j in range(iStrips)])
+    f = open(fName, "wb")
+    f.write(b'II' + struct.pack("<HI", 42, 8))
+    f.write(struct.pack("<H", len(lTags)))
+    iPos = 8 + iIFDSize
+    bOutOfLine = b''
+    for i in range(len(lTags)):
+        iCount = len(lTags[i][2])+1 if lTags[i][1] == 2 else len(lTags[i][2])
+        if len(lValues[i]) > 4:
+            f.write(struct.pack("<HHII", lTags[i][0], lTags[i][1], iCount, iPos))
+            bOutOfLine += lValues[i] + b'\0'*(len(lValues[i]) % 2)
+            iPos += len(lValues[i]) + (len(lValues[i]) % 2)
+        else:
+            f.write(struct.pack("<HHI", lTags[i][0], lTags[i][1], iCount) + lValues[i].ljust(4, b'\0'))
+    f.write(struct.pack("<I", 0))
+    f.write(bOutOfLine)
+    f.truncate(iData+iBytes)
+    f.close()
+    shape = (yH, xW) if iBands == 1 else (yH, xW, iBands)
+    return numpy.memmap(fName, dtype=dtype, mode='r+', offset=iData, shape=shape)
+
+
+def mosaic_gtis(lImgs, fName, lBox=None, iRows=512):
+    """
+    Mosaic the given GTImages (which should have the same pixel size, dtype and bands) into a new GeoTiff.
+    The output covers the union of the images, cropped to lBox [lon0, lat0, lon1, lat1] if given.
+    Each image is copied into place, a strip of rows at a time, using windowed reads, so only the
+    output (which is memory mapped) and a strip need to be in memory.
+    Returns the geo info (SLon, SLat, DLon, DLat) and size (XW, YH) of the mosaic.
+    """
+    img0 = lImgs[0]
+    for img in lImgs:
+        if (abs(img.dLon-img0.dLon) > abs(img0.dLon)*1e-6) or (abs(img.dLat-img0.dLat) > abs(img0.dLat)*1e-6):
+            raise RuntimeError("imgutils:Mosaic:{}: Resolution {},{} doesnt match {},{}".format(img.fName, img.dLon, img.dLat, img0.dLon, img0.dLat))
+        if img.pImg.mode != img0.pImg.mode:
+            raise RuntimeError("imgutils:Mosaic:{}: Mode {} doesnt match {}".format(img.fName, img.pImg.mode, img0.pImg.mode))
+    if img0.pImg.mode == 'P':
+        raise RuntimeError("imgutils:Mosaic: Palette images are not supported")
+    # The pixel grid of the mosaic, with the images' positions in it
+    oLon = min([ img.sLon for img in lImgs ]) if img0.dLon > 0 else max([ img.sLon for img in lImgs ])
+    oLat = max([ img.sLat for img in lImgs ]) if img0.dLat < 0 else min([ img.sLat for img in lImgs ])
+    lPos = []
+    for img in lImgs:
+        fX, fY = (img.sLon-oLon)/img0.dLon, (img.sLat-oLat)/img0.dLat
+        if (abs(fX-round(fX)) > 0.01) or (abs(fY-round(fY)) > 0.01):
+            print("WARN:Mosaic:{}: Not aligned to the pixel grid, off by {},{}".format(img.fName, fX-round(fX), fY-round(fY)))
+        lPos.append([round(fX), round(fY)])
+    x0, y0 = 0, 0
+    x1 = max([ lPos[i][0]+lImgs[i].XW for i in range(len(lImgs)) ])
+    y1 = max([ lPos[i][1]+lImgs[i].YH for i in range(len(lImgs)) ])
+    if lBox != None:
+        fX = (numpy.array([lBox[0], lBox[2]]) - oLon)/img0.dLon
+        fY = (numpy.array([lBox[1], lBox[3]]) - oLat)/img0.dLat
+        # Allow for float error in the box edges, as done for the image positions above
+        x0, x1 = max(int(numpy.floor(fX.min()+0.01)), x0), min(int(numpy.ceil(fX.max()-0.01)), x1)
+        y0, y1 = max(int(numpy.floor(fY.min()+0.01)), y0), min(int(numpy.ceil(fY.max()-0.01)), y1)
+        if (x0 >= x1) or (y0 >= y1):
+            raise RuntimeError("imgutils:Mosaic: Box {} is outside the images".format(lBox))
+    dGeo = { 'SLon': oLon+x0*img0.dLon, 'SLat': oLat+y0*img0.dLat, 'DLon': img0.dLon, 'DLat': img0.dLat, 'XW': x1-x0, 'YH': y1-y0 }
+    iBands = len(img0.pImg.getbands())
+    wImg0 = WindowedImage(img0.fName, img0.pImg)
+    dtype = wImg0.read(0, 0, 1, 1).dtype
+    print("\tMosaic", len(lImgs), (x1-x0, y1-y0), dtype, iBands, dGeo)
+    rOut = geotiff_memmap(fName, x1-x0, y1-y0, dtype, iBands, dGeo)
+    for i in range(len(lImgs)):
+        img = lImgs[i]
+        # The part of the image within the output, in the image's own pixel coordinates
+        iX0, iX1 = max(x0-lPos[i][0], 0), min(x1-lPos[i][0], img.XW)
+        iY0, iY1 = max(y0-lPos[i][1], 0), min(y1-lPos[i][1], img.YH)
+        if (iX0 >= iX1) or (iY0 >= iY1):
+            print("INFO:Mosaic:{}: Outside the box, skipping".format(img.fName))
+            continue
+        print("INFO:Mosaic:{}:{},{}-{},{}".format(img.fName, iX0, iY0, iX1, iY1))
+        wImg = WindowedImage(img.fName, img.pImg)
+        oX0 = lPos[i][0]+iX0-x0
+        for iS in range(iY0, iY1, iRows):
+            iE = min(iS+iRows, iY1)
+            oS = lPos[i][1]+iS-y0
+            rOut[oS:oS+iE-iS, oX0:oX0+iX1-iX0] = wImg.read(iX0, iS, iX1, iE)
+    rOut.flush()
+    del(rOut)
+    return dGeo
+
+
+def get_geobounds(fName):
+    """
+    Get the geo bounds of the given image, if its a GeoTiff, else return None.
+    Only the tags are parsed, the image data is not loaded.
+    """
+    try:
+        gtImg = GTImage(fName, "GEO")
+    except:
+        return None
+    return gtImg.get_geobounds()
+
+
+def hash_file(fName, iChunk=1<<20):
+    """
+    Return the sha256 hexdigest of the contents of the given file.
+    """
+    h = hashlib.sha256()
+    f = open(fName, "rb")
+    while True:
+        data = f.read(iChunk)
+        if len(data) == 0:
+            break
+        h.update(data)
+    f.close()
+    return h.hexdigest()
+
 
 def load_rimg(fName, bTranspose=False):
+    sKey = None
+    if cache_enabled():
+        sKey = cache_key("load_rimg", hash_file(fName), bTranspose)
+        trImg = cache_get(sKey)
+        if type(trImg) != type(None):
+            return trImg
     pImg = PIL.Image.open(fName)
     rImg = numpy.array(pImg)
     if bTranspose:
         trImg = transpose_rimg(rImg)
     else:
         trImg = rImg
+    cache_put(sKey, trImg)
     return trImg
 
 
@@ -228,24 +787,129 @@ def resize_pwrof2square_rimg(rImg, extra=0, resizeFilter=-1):
     The resultant image could be larger than either of the input dimensions, if they werent powersof2.
     It also allows a additional extra size to be added beyond powerof2.
         This (rather extra=1) is needed by Panda3D GeoMipTerrain files.
-    NOTE: Currently it uses PIL Image resize.
     """
+    sKey = None
+    if cache_enabled():
+        # The last part identifies the resampler version, so entries from the older PIL based resize arent reused
+        sKey = cache_key("resize_pwrof2square_rimg", hash_rimg(rImg), extra, resizeFilter, "np1")
+        rNew = cache_get(sKey)
+        if type(rNew) != type(None):
+            return rNew
     sNew = numpy.ceil(numpy.max(numpy.log2(rImg.shape)))
     sNew = int((2**sNew)+extra)
-    return resize_rimg(rImg, sNew, sNew, resizeFilter)
+    rNew = resize_rimg(rImg, sNew, sNew, resizeFilter)
+    cache_put(sKey, rNew)
+    return rNew
+
+
+# The kernels used by the resampler when upsampling, along with their support, indexed by the PIL filter id.
+gResampleKernels = {
+        PIL.Image.BOX: [ 0.5, lambda t: ((t > -0.5) & (t <= 0.5)).astype(numpy.float64) ],
+        PIL.Image.BILINEAR: [ 1.0, lambda t: numpy.clip(1-numpy.abs(t), 0, None) ],
+        PIL.Image.HAMMING: [ 1.0, lambda t: numpy.where(numpy.abs(t) < 1, numpy.sinc(t)*(0.54+0.46*numpy.cos(numpy.pi*t)), 0) ],
+        PIL.Image.BICUBIC: [ 2.0, lambda t: numpy.where(numpy.abs(t) < 1, (1.5*numpy.abs(t)-2.5)*t*t+1,
+                                numpy.where(numpy.abs(t) < 2, ((-0.5*numpy.abs(t)+2.5)*numpy.abs(t)-4)*numpy.abs(t)+2, 0)) ],
+        PIL.Image.LANCZOS: [ 3.0, lambda t: numpy.where(numpy.abs(t) < 3, numpy.sinc(t)*numpy.sinc(t/3), 0) ],
+        }
+
+
+def _resample_weights(iIn, iOut, resizeFilter):
+    """
+    Get the source indexes and weights (each of shape [iOut, taps]) to resample a axis of size iIn to iOut.
+    The sampling positions match PIL's ie output pixel i is centered at (i+0.5)*iIn/iOut in the source.
+    Downsampling averages the source pixels covered by each output pixel, weighted by their area of overlap.
+    Upsampling uses the kernel of the given filter. Taps falling outside the source get zero weight.
+    """
+    fScale = iIn/iOut
+    fC = (numpy.arange(iOut)+0.5)*fScale
+    if resizeFilter == PIL.Image.NEAREST:
+        iIdx = numpy.minimum(numpy.floor(fC).astype(numpy.int64), iIn-1)[:,numpy.newaxis]
+        return iIdx, numpy.ones(iIdx.shape)
+    if fScale > 1:
+        fSupport = fScale/2
+    else:
+        fSupport, kernel = gResampleKernels[resizeFilter]
+    iStart = numpy.floor(fC - fSupport).astype(numpy.int64)
+    iX = iStart[:,numpy.newaxis] + numpy.arange(int(numpy.ceil(2*fSupport))+2)
+    fC = fC[:,numpy.newaxis]
+    if fScale > 1:
+        fW = numpy.clip(numpy.minimum(iX+1, fC+fSupport) - numpy.maximum(iX, fC-fSupport), 0, None)
+    else:
+        fW = kernel(iX+0.5-fC)
+    fW[(iX < 0) | (iX >= iIn)] = 0
+    fW /= fW.sum(axis=1, keepdims=True)
+    return numpy.clip(iX, 0, iIn-1), fW
+
+
+def _resample_rows(rIn, iIdxY, fWY, iIdxX, fWX, dtype):
+    """
+    Resample the given rows along y and then x, with the given indexes and weights (iIdxY relative to rIn).
+    The math is done in float64, with integer results rounded and clipped to the range of dtype.
+    """
+    fIn = rIn.astype(numpy.float64)
+    lBands = (1,)*(fIn.ndim-2)
+    fT = 0
+    for k in range(iIdxY.shape[1]):
+        fT = fT + fWY[:,k].reshape((-1,1)+lBands)*fIn[iIdxY[:,k]]
+    fO = 0
+    for k in range(iIdxX.shape[1]):
+        fO = fO + fWX[:,k].reshape((1,-1)+lBands)*fT[:,iIdxX[:,k]]
+    if numpy.issubdtype(dtype, numpy.integer):
+        dInfo = numpy.iinfo(dtype)
+        fO = numpy.clip(numpy.rint(fO), dInfo.min, dInfo.max)
+    return fO.astype(dtype)
 
 
-def resize_rimg(rImg, xs, ys, resizeFilter=-1):
+def resize_rimg(rImg, xs, ys, resizeFilter=-1, iChunkRows=256, rOut=None):
     """
-    Resize the given raw image to specified size.
-    resizeFilter specifies the filter to use. Refer to PIL.Image documentation for the options.
+    Resize the given raw image ([y, x] or [y, x, band]) to specified size, preserving its dtype.
+    resizeFilter specifies the PIL filter whose kernel to use, when upsampling.
+        Downsampling uses area averaging, except for NEAREST.
+    The output is generated a chunk of iChunkRows (scaled down if downsampling) rows at a time,
+    into rOut if given (which could be a numpy.memmap).
     """
-    pImg =PIL.Image.fromarray(rImg)
     if resizeFilter < 0:
         resizeFilter = PIL.Image.BILINEAR
     print("\tImageResize", rImg.shape, xs, ys, resizeFilter)
-    prImg=pImg.resize((xs, ys), resample=resizeFilter)
-    return numpy.array(prImg)
+    iIdxY, fWY = _resample_weights(rImg.shape[0], ys, resizeFilter)
+    iIdxX, fWX = _resample_weights(rImg.shape[1], xs, resizeFilter)
+    if type(rOut) == type(None):
+        rOut = numpy.empty((ys, xs)+rImg.shape[2:], dtype=rImg.dtype)
+    iChunkRows = max(int(iChunkRows*ys/rImg.shape[0]), 1) if ys < rImg.shape[0] else iChunkRows
+    for o0 in range(0, ys, iChunkRows):
+        o1 = min(o0+iChunkRows, ys)
+        iS, iE = iIdxY[o0:o1].min(), iIdxY[o0:o1].max()+1
+        rOut[o0:o1] = _resample_rows(rImg[iS:iE], iIdxY[o0:o1]-iS, fWY[o0:o1], iIdxX, fWX, rOut.dtype)
+    return rOut
+
+
+def pyramid_levels(xW, yH, iTileSize, iMaxLevels=-1):
+    """
+    Get the number of levels in a quadtree tile pyramid of iTileSize (2^n+1) sized tiles,
+    so that its finest level matches or exceeds the given image size.
+    Level L has 2^L x 2^L tiles, which together cover (iTileSize-1)*2^L+1 pixels along each axis.
+    """
+    iLevels = 1
+    while ((iTileSize-1)*2**(iLevels-1)+1) < max(xW, yH):
+        iLevels += 1
+    if iMaxLevels > 0:
+        iLevels = min(iLevels, iMaxLevels)
+    return iLevels
+
+
+def pyramid_tiles_rimg(rImg, iTileSize):
+    """
+    Cut the passed raw image (in [y, x] orientation and sized (iTileSize-1)*2^L+1 along each axis)
+    into iTileSize x iTileSize tiles. Neighbouring tiles share their border row/col, so that
+    the terrains generated from them match at the borders.
+    Yields tx, ty, tile (a view into rImg), with ty=0 being the top row of tiles.
+    """
+    iTiles = (rImg.shape[0]-1)//(iTileSize-1)
+    for ty in range(iTiles):
+        for tx in range(iTiles):
+            y0 = ty*(iTileSize-1)
+            x0 = tx*(iTileSize-1)
+            yield tx, ty, rImg[y0:y0+iTileSize, x0:x0+iTileSize]
 
 
 def crop_rimg(rImg, xStartOrSize, yStartOrSize, xEnd=None, yEnd=None):
@@ -288,55 +952,110 @@ def add_noise_rimg(rImg, fNoiseRatio=0.1):
     return rImg
 
 
+def _blur_acc_dtype(rImg, iBlurSize):
+    """
+    Pick the dtype to use for the running sums of blur_filter_rimg.
+    Integer images use int32 if the sums cant overflow it, so that the sums are exact.
+    """
+    if (rImg.dtype.kind == 'f'):
+        return numpy.float64
+    maxSum = int(numpy.iinfo(rImg.dtype).max)*(2*iBlurSize+1)*(max(rImg.shape[0], rImg.shape[1])+1)
+    if maxSum < numpy.iinfo(numpy.int32).max:
+        return numpy.int32
+    return numpy.int64
+
+
+def _blur_window_sums(dS, cS, iBlurSize, axis, bEdgeStyle):
+    """
+    Fill dS with the sums of the windows along the given axis, using the running sum cS,
+    which has a leading 0 along that axis ie cS[k] is the sum of the first k entries.
+    The windows cover
+        bEdgeStyle False: -iBlurSize to +iBlurSize around each position.
+            Only positions which are iBlurSize or more away from both ends are filled.
+        bEdgeStyle True: 2*iBlurSize positions
+            starting at the current position, for positions near the start.
+            -iBlurSize to +iBlurSize-1 around the current position, for positions in between.
+            ending just before the current position, for positions near the end.
+    """
+    b = iBlurSize
+    n = dS.shape[axis]
+    def sl(s, e):
+        if axis == 0:
+            return numpy.s_[s:e]
+        return numpy.s_[:,s:e]
+    if not bEdgeStyle:
+        numpy.subtract(cS[sl(2*b+1,n+1)], cS[sl(0,n-2*b)], out=dS[sl(b,n-b)])
+        return
+    numpy.subtract(cS[sl(2*b,3*b)], cS[sl(0,b)], out=dS[sl(0,b)])
+    numpy.subtract(cS[sl(2*b,n)], cS[sl(0,n-2*b)], out=dS[sl(b,n-b)])
+    numpy.subtract(cS[sl(n-b,n)], cS[sl(n-3*b,n-2*b)], out=dS[sl(n-b,n)])
+
+
 def blur_filter_rimg(rImg, iBlurSize=1, bBlurEdges=True):
     """
     Blur all channels of passed raw image (numpy array) by doing a NxN based filtering
     where each pixel is averaged from a window around its position
     of size -iBlurSize to +iBlurSize along x and y axis.
+
+    If bBlurEdges, the pixels in the iBlurSize wide edges of the image are averaged from a
+    2*iBlurSize wide window, which is pushed into the image wrt the axis along which the
+    pixel is near the edge, plus a extra weightage for the pixel itself.
+    Else the edges are left as is.
+
+    The window sums are got from running sums (ie a summed area table) along x and then y,
+    so the cost doesnt depend on iBlurSize. For integer images the sums are exact.
     """
     print("\tBlur")
-    #breakpoint()
-    xS = yS = iBlurSize
-    xE = rImg.shape[0]-iBlurSize
-    yE = rImg.shape[1]-iBlurSize
-    fImg = rImg/rImg.max()
-    dImg = numpy.zeros(rImg.shape)
+    if iBlurSize < 1:
+        return rImg
+    sKey = None
+    if cache_enabled():
+        sKey = cache_key("blur_filter_rimg", hash_rimg(rImg), iBlurSize, bBlurEdges)
+        dImg = cache_get(sKey)
+        if type(dImg) != type(None):
+            return dImg
+    b = iBlurSize
+    cnt = (2*b+1)**2
+    accDType = _blur_acc_dtype(rImg, b)
+    xW, yH = rImg.shape[0], rImg.shape[1]
+    # The running sum buffers along x and y, and the window sums along x
+    cSX = numpy.zeros((xW+1,)+rImg.shape[1:], dtype=accDType)
+    cSY = numpy.zeros((xW,yH+1)+rImg.shape[2:], dtype=accDType)
+    dSX = numpy.zeros(rImg.shape, dtype=accDType)
+    numpy.cumsum(rImg, axis=0, dtype=accDType, out=cSX[1:])
     # Handle the edge rows/cols
     if bBlurEdges:
-        scaleBy = (iBlurSize+1)*2
-        dImg[:iBlurSize] = fImg[:iBlurSize]*scaleBy
-        dImg[-iBlurSize:] = fImg[-iBlurSize:]*scaleBy
-        dImg[:,:iBlurSize] = fImg[:,:iBlurSize]*scaleBy
-        dImg[:,-iBlurSize:] = fImg[:,-iBlurSize:]*scaleBy
-        for x in range(-iBlurSize,iBlurSize):
-            for y in range(-iBlurSize,iBlurSize):
-                # top and bottom bands
-                dImg[iBlurSize:-iBlurSize,:iBlurSize] += fImg[iBlurSize+x:-iBlurSize+x, iBlurSize+y:2*iBlurSize+y]
-                dImg[iBlurSize:-iBlurSize,-iBlurSize:] += fImg[iBlurSize+x:-iBlurSize+x,-2*iBlurSize+y:-iBlurSize+y]
-                # left and right bands
-                dImg[:iBlurSize, iBlurSize:-iBlurSize] += fImg[iBlurSize+x:2*iBlurSize+x, iBlurSize+y:-iBlurSize+y]
-                dImg[-iBlurSize:,iBlurSize:-iBlurSize] += fImg[-2*iBlurSize+x:-iBlurSize+x, iBlurSize+y:-iBlurSize+y]
-                # corners
-                dImg[:iBlurSize,:iBlurSize] += fImg[iBlurSize+x:2*iBlurSize+x,iBlurSize+y:2*iBlurSize+y]
-                dImg[-iBlurSize:,-iBlurSize:] += fImg[-2*iBlurSize+x:-iBlurSize+x,-2*iBlurSize+y:-iBlurSize+y]
-                dImg[-iBlurSize:,:iBlurSize] += fImg[-2*iBlurSize+x:-iBlurSize+x,iBlurSize+y:2*iBlurSize+y]
-                dImg[:iBlurSize,-iBlurSize:] += fImg[iBlurSize+x:2*iBlurSize+x,-2*iBlurSize+y:-iBlurSize+y]
+        _blur_window_sums(dSX, cSX, b, 0, True)
+        numpy.cumsum(dSX, axis=1, out=cSY[:,1:])
+        lEdges = []
+        for sl in [ numpy.s_[:b], numpy.s_[-b:] ]:
+            dEdge = numpy.empty(rImg[sl].shape, dtype=accDType)
+            _blur_window_sums(dEdge, cSY[sl], b, 1, True)
+            lEdges.append((sl, dEdge))
+        lEdges.append((numpy.s_[:,:b], cSY[:,2*b:3*b] - cSY[:,:b]))
+        lEdges.append((numpy.s_[:,-b:], cSY[:,yH-b:yH] - cSY[:,yH-3*b:yH-2*b]))
+        for sl, dEdge in lEdges:
+            dEdge += rImg[sl].astype(accDType)*((b+1)*2)
     else:
-        scaleBy = (2*iBlurSize+1)**2
-        dImg[:iBlurSize] = fImg[:iBlurSize]*scaleBy
-        dImg[-iBlurSize:] = fImg[-iBlurSize:]*scaleBy
-        dImg[:,:iBlurSize] = fImg[:,:iBlurSize]*scaleBy
-        dImg[:,-iBlurSize:] = fImg[:,-iBlurSize:]*scaleBy
+        lEdges = []
+        for sl in [ numpy.s_[:b], numpy.s_[-b:], numpy.s_[:,:b], numpy.s_[:,-b:] ]:
+            lEdges.append((sl, rImg[sl].astype(accDType)*cnt))
     # Handle the non edge parts
-    cnt = 0
-    for x in range(-iBlurSize,iBlurSize+1,1):
-        for y in range(-iBlurSize,iBlurSize+1,1):
-            cnt += 1
-            dImg[xS:xE,yS:yE] += fImg[xS+x:xE+x, yS+y:yE+y]
+    _blur_window_sums(dSX, cSX, b, 0, False)
+    del(cSX)
+    numpy.cumsum(dSX, axis=1, out=cSY[:,1:])
+    _blur_window_sums(dSX, cSY, b, 1, False)
+    del(cSY)
+    for sl, dEdge in lEdges:
+        dSX[sl] = dEdge
     # scale/average it
-    fImg = (dImg*rImg.max())/cnt
-    rImg = numpy.round(fImg).astype(rImg.dtype)
-    return rImg
+    dImg = numpy.empty(rImg.shape, dtype=rImg.dtype)
+    for iS in range(0, xW, 256):
+        fChunk = dSX[iS:iS+256].astype(numpy.float32)
+        fChunk /= cnt
+        dImg[iS:iS+256] = numpy.round(fChunk)
+    cache_put(sKey, dImg)
+    return dImg
 
 
 def flip_rimg(rImg, bFlipVert=True):
@@ -348,43 +1067,101 @@ def flip_rimg(rImg, bFlipVert=True):
     return tImg
 
 
-def hf2cm_rimg(rImg):
+def get_cmramp(sRamp=None):
+    """
+    Get the ColorMap ramp with the given name from gCMRamps, or else load it from the given json file.
+    """
+    if sRamp == None:
+        sRamp = gCfg['sCMRamp']
+    lRamp = gCMRamps.get(sRamp)
+    if lRamp == None:
+        f = open(sRamp)
+        lRamp = json.load(f)
+        f.close()
+    if len(lRamp) < 2:
+        raise RuntimeError("imgutils:GetCMRamp: Ramp {} needs atleast 2 bands".format(sRamp))
+    return lRamp
+
+
+def hf2cm_rimg(rImg, lRamp=None, dtype=numpy.float32, iChunkRows=256):
     """
     Create ColorMap for the given heightfield image, based on the height (color/shade value).
-    ToThink: Maybe convert to NumPys parallel conditional indexing and updating, later.
+    The height bands and their colors are picked from the given ColorMap ramp (refer to gCMRamps).
+    The logic works on whole rows at a time (iChunkRows of them), one band after the other.
+    The band logic uses float64 only for the current chunk, while the returned colormap is
+        float32 (with color values in the range 0.0 to 1.0) by default, OR
+        uint8, if requested, which is same as what save_rimg would have saved for a float64 colormap.
     """
     print("\tHF2CM")
+    if lRamp == None:
+        lRamp = get_cmramp()
     if (rImg.dtype != numpy.float64) and (rImg.dtype != numpy.float32):
         maxV = numpy.iinfo(rImg.dtype).max
-        rImg = rImg/maxV
-    cN = numpy.zeros((rImg.shape[0], rImg.shape[1], 3), dtype=numpy.float64)
-    for x in range(rImg.shape[0]):
-        for y in range(rImg.shape[1]):
-            if rImg[x,y] <= 0:
-                cN[x,y] = [0, 0, 1]
-            elif rImg[x,y] < 0.20:
-                gF = 0.2 + 0.8*(rImg[x,y]/0.20)
-                cN[x,y] = [0, gF, 0]
-            elif rImg[x,y] < 0.40:
-                shade = 0.2 + 0.8*((rImg[x,y]-0.20)/0.20)
-                cN[x,y] = [0.5*shade, 0.25*shade, 0]
+    else:
+        maxV = None
+    lColors = [ numpy.array(band[1], dtype=numpy.float64) for band in lRamp ]
+    cN = numpy.empty((rImg.shape[0], rImg.shape[1], 3), dtype=dtype)
+    for iS in range(0, rImg.shape[0], iChunkRows):
+        if maxV == None:
+            fImg = rImg[iS:iS+iChunkRows].astype(numpy.float64)
+        else:
+            fImg = rImg[iS:iS+iChunkRows]/maxV
+        cC = numpy.empty((fImg.shape[0], fImg.shape[1], 3), dtype=numpy.float64)
+        mDone = numpy.zeros(fImg.shape, dtype=bool)
+        fFrom = None
+        for i in range(len(lRamp)):
+            fUpTo, color, fShadeBase, fShadeRange = lRamp[i]
+            if i == 0:
+                mBand = fImg <= fUpTo
+            elif i == (len(lRamp)-1):
+                mBand = ~mDone
             else:
-                cF = 0.2 + 0.8*((rImg[x,y]-0.40)/0.60)
-                cN[x,y] = cF
+                mBand = fImg < fUpTo
+                mBand &= ~mDone
+            if fFrom == None:
+                cC[mBand] = lColors[i]*fShadeBase
+            else:
+                shade = fShadeBase + fShadeRange*((fImg[mBand]-fFrom)/(fUpTo-fFrom))
+                cC[mBand] = shade[:,numpy.newaxis]*lColors[i]
+            mDone |= mBand
+            fFrom = fUpTo
+        if dtype == numpy.uint8:
+            cC = to_uint8(cC, 0.0, 1.0)
+        cN[iS:iS+iChunkRows] = cC
     return cN
 
 
 def map_objects_gti(imgS, db):
     """
     For the given GeoTiff image, check if any objects are there in the given objects db, in the corresponding region.
+    The objects around the image's lon/lat bounds are fetched from the db in one go, rather than looking up
+    the db for each pixel. The pixel to object mapping is the same as that of a per pixel odb.get, ie an object
+    is mapped to all the pixels whose lat-lon match its odb key (0.01 degree resolution, refer to odb._key),
+    with only the first object for a given key being used.
+    The returned list is ordered by x and then y.
     """
-    ll = []
+    lObjs = odb.query_bbox(db, min(imgS.sLat, imgS.eLat)-0.01, min(imgS.sLon, imgS.eLon)-0.01,
+                            max(imgS.sLat, imgS.eLat)+0.01, max(imgS.sLon, imgS.eLon)+0.01)
+    if len(lObjs) == 0:
+        return []
+    # The odb key parts of the pixel columns (lon) and rows (lat), as got by xy2coord
+    dLonX = {}
     for x in range(imgS.XW):
-        for y in range(imgS.YH):
-            lon, lat = imgS.xy2coord(x,y)
-            obj = odb.get(db, lat, lon)
-            if obj != None:
+        dLonX.setdefault("{:6.2f}".format(imgS.sLon + imgS.dLon*x), []).append(x)
+    dLatY = {}
+    for y in range(imgS.YH):
+        dLatY.setdefault("{:6.2f}".format(imgS.sLat + imgS.dLat*y), []).append(y)
+    ll = []
+    sKeys = set()
+    for obj in lObjs:
+        sLat, sLon = "{:6.2f}".format(float(obj['lat'])), "{:6.2f}".format(float(obj['lon']))
+        if (sLat, sLon) in sKeys:
+            continue
+        sKeys.add((sLat, sLon))
+        for x in dLonX.get(sLon, []):
+            for y in dLatY.get(sLat, []):
                 ll.append([x, y, obj['icao']])
+    ll.sort(key=lambda l: (l[0], l[1]))
     return ll
 
 
@@ -393,21 +1170,40 @@ def mapto_ex_gti(imgS, imgR):
     MapToExtended: Create new raw image which maps the given imgS to match equivalent map coord position colors in imgR.
     imgS and imgR should be of GTImage type.
     return rCM: the raw color map numpy array (i.e not a GTImage class instance)
+    The lon/lat grid of imgS is mapped to imgR pixel positions in one go, followed by a single gather.
+    Positions which fall outside imgR are left black.
     It optionally applies some noise, blur and flip operations, if requested.
     """
-    rCM = numpy.zeros((imgS.rImg.shape[0], imgS.rImg.shape[1], imgR.rImg.shape[2]), dtype=imgR.rImg.dtype)
-    print("\tMapToExtended:", rCM.shape, rCM.dtype)
-    if gCfg['bMoreBluey']:
-        cmThreshold = int(numpy.iinfo(rCM.dtype).max/2)
-        print("BlueThreshold", cmThreshold)
-    for x in range(imgS.XW):
-        for y in range(imgS.YH):
-            lon, lat = imgS.xy2coord(x,y)
-            color = imgR.getpixel_coord(lon, lat)
-            if gCfg['bMoreBluey'] and (color[0] == 0) and (color[1] == 0):
-                if color[2] < cmThreshold:
-                    color[2] = 0.5*cmThreshold + color[2]*1.2
-            rCM[x,y] = color
+    print("\tMapToExtended:", (imgS.XW, imgS.YH), imgR.pImg.mode)
+    sKey = None
+    rCM = None
+    if cache_enabled():
+        sKey = cache_key("mapto_ex_gti", hash_file(imgS.fName), hash_file(imgR.fName), gCfg['bMoreBluey'])
+        rCM = cache_get(sKey)
+    if type(rCM) == type(None):
+        lon, lat = imgS.xy2coord_arr(numpy.arange(imgS.XW)[:,numpy.newaxis], numpy.arange(imgS.YH)[numpy.newaxis,:])
+        xR, yR, bInside = imgR.coord2xy_arr(lon, lat)
+        xR, yR = numpy.broadcast_arrays(xR, yR)
+        if numpy.any(bInside):
+            # Decode only the part of imgR covering imgS
+            xR0, xR1 = int(xR[bInside].min()), int(xR[bInside].max())+1
+            yR0, yR1 = int(yR[bInside].min()), int(yR[bInside].max())+1
+            rWin = imgR.read_xy(xR0, yR0, xR1, yR1)
+            rCM = rWin[numpy.where(bInside, xR-xR0, 0), numpy.where(bInside, yR-yR0, 0)]
+        else:
+            rWin = imgR.read_xy(0, 0, 1, 1)
+            rCM = numpy.zeros((imgS.XW, imgS.YH)+rWin.shape[2:], dtype=rWin.dtype)
+        iOutside = bInside.size - numpy.count_nonzero(bInside)
+        if iOutside > 0:
+            print("WARN:MapToExtended:{} positions outside {}".format(iOutside, imgR.tag))
+            rCM[~bInside] = 0
+        if gCfg['bMoreBluey']:
+            cmThreshold = int(numpy.iinfo(rCM.dtype).max/2)
+            print("BlueThreshold", cmThreshold)
+            rB = rCM[:,:,2]
+            mBluey = (rCM[:,:,0] == 0) & (rCM[:,:,1] == 0) & (rB < cmThreshold)
+            rB[mBluey] = (0.5*cmThreshold + rB[mBluey]*1.2).astype(rCM.dtype)
+        cache_put(sKey, rCM)
     if gCfg['bAddNoise']:
         rCM = add_noise_rimg(rCM,gCfg['fNoiseRatio'])
     if gCfg['bBlur']:
@@ -438,14 +1234,10 @@ def reduce_shades_crude_rimg(rImg, numShades=8, blurSize=4):
     return tImg
 
 
-def amplify_shades_fimg(fImg, bBoostAmplify=True):
+def amplify_mult(iHist):
     """
-    Increase Image pixel values.
-    This returns a image data array with floats in range 0 to 1.
+    Decide the amplification multiplier, based on the 20 bin histogram of the image.
     """
-    if not bBoostAmplify:
-        return fImg/fImg.max()
-    iHist = numpy.histogram(fImg,20)[0]
     iHTotal = numpy.sum(iHist)
     iMult = 1
     for i in range(4):
@@ -453,12 +1245,83 @@ def amplify_shades_fimg(fImg, bBoostAmplify=True):
         if (iHPart/iHTotal) > 0.9:
             iMult = int(6/(i+1))
             break
-    print("\tAmplifyShades", iMult)
-    ampdImg = (fImg/fImg.max())*iMult
-    clippedImg = numpy.clip(ampdImg, 0, 1)
+    return iMult
+
+
+def amplify_shades_fimg(fImg, bBoostAmplify=True):
+    """
+    Increase Image pixel values.
+    This returns a image data array with floats in range 0 to 1.
+    """
+    sKey = None
+    if cache_enabled():
+        sKey = cache_key("amplify_shades_fimg", hash_rimg(fImg), bBoostAmplify)
+        clippedImg = cache_get(sKey)
+        if type(clippedImg) != type(None):
+            return clippedImg
+    if not bBoostAmplify:
+        clippedImg = fImg/fImg.max()
+    else:
+        iHist = numpy.histogram(fImg,20)[0]
+        iMult = amplify_mult(iHist)
+        print("\tAmplifyShades", iMult)
+        ampdImg = (fImg/fImg.max())*iMult
+        clippedImg = numpy.clip(ampdImg, 0, 1)
+    cache_put(sKey, clippedImg)
     return clippedImg
 
 
+def amplify_stats_wimg(wImg, bBoostAmplify=True, iRows=512):
+    """
+    Get the global max and the amplification multiplier (refer to amplify_shades_fimg),
+    by going through the given WindowedImage a strip at a time.
+    """
+    fMin, fMax = None, None
+    for y0, y1, yS, rStrip in wImg.rows(iRows):
+        if fMax == None:
+            fMin, fMax = rStrip.min(), rStrip.max()
+        else:
+            fMin, fMax = min(fMin, rStrip.min()), max(fMax, rStrip.max())
+    if not bBoostAmplify:
+        return fMax, 1
+    iHist = numpy.zeros(20, dtype=numpy.int64)
+    for y0, y1, yS, rStrip in wImg.rows(iRows):
+        iHist += numpy.histogram(rStrip, 20, range=(fMin, fMax))[0]
+    iMult = amplify_mult(iHist)
+    print("\tAmplifyShades", iMult)
+    return fMax, iMult
+
+
+def amplify_resize_wimg(wImg, xs, ys, fMax, iMult, bBoostAmplify, rOut, resizeFilter=-1, iRows=512):
+    """
+    Amplify (refer to amplify_shades_fimg) and resize (refer to resize_rimg) the given WindowedImage,
+    into rOut (a float32 [ys, xs] array, which could be a numpy.memmap), a strip of output rows at a time.
+    Each strip is resampled from just the source rows it needs, using the full image's weights,
+    so the result matches resize_rimg of the full amplified image.
+    Returns the min and max of the output.
+    """
+    if resizeFilter < 0:
+        resizeFilter = PIL.Image.BILINEAR
+    print("\tAmplifyResizeStream", (wImg.XW, wImg.YH), xs, ys, resizeFilter)
+    iIdxY, fWY = _resample_weights(wImg.YH, ys, resizeFilter)
+    iIdxX, fWX = _resample_weights(wImg.XW, xs, resizeFilter)
+    iRows = max(int(iRows*ys/wImg.YH), 1) if ys < wImg.YH else iRows
+    oMin, oMax = None, None
+    for o0 in range(0, ys, iRows):
+        o1 = min(o0+iRows, ys)
+        yS, yE = iIdxY[o0:o1].min(), iIdxY[o0:o1].max()+1
+        fStrip = wImg.read(0, yS, wImg.XW, yE)/fMax
+        if bBoostAmplify:
+            fStrip *= iMult
+            fStrip = numpy.clip(fStrip, 0, 1)
+        rOut[o0:o1] = _resample_rows(fStrip, iIdxY[o0:o1]-yS, fWY[o0:o1], iIdxX, fWX, rOut.dtype)
+        if oMax == None:
+            oMin, oMax = rOut[o0:o1].min(), rOut[o0:o1].max()
+        else:
+            oMin, oMax = min(oMin, rOut[o0:o1].min()), max(oMax, rOut[o0:o1].max())
+    return oMin, oMax
+
+
 def amplify_shades_rimg(rImg, bBoostAmplify=True):
     maxV = numpy.iinfo(rImg.dtype).max
     fImg = rImg/maxV
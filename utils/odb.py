@@ -1,9 +1,106 @@
 # Objects DB - Maintain a list of objects and their co-ords
 # HanishKVC, 2021
 # GPL
-
-
+#
+# Two backends are supported
+#   dict: a pickled dict of objects, keyed by their lat-lon (at 0.01 degree resolution).
+#   columnar: a memory mappable file (refer to store_columnar), which keeps the lat/lon of all
+#       the objects as float arrays, their icao and name in string tables, and a uniform lat/lon
+#       grid index (the objects are sorted by grid cell, with the start of each cell recorded).
+#       It is readonly, and allows multiple objects at the same position.
+# load detects the backend of the given file, and the other functions work with either.
+#
+
+
+import sys
 import pickle
+import numpy
+
+
+COL_MAGIC = b'HKVCODB1'
+COL_HDR_DTYPE = numpy.dtype([
+        ('magic', 'S8'),
+        ('count', '<u8'),
+        ('nlat', '<u4'),
+        ('nlon', '<u4'),
+        ('celldeg', '<f8'),
+        ('olat', '<u8'),
+        ('olon', '<u8'),
+        ('ocell', '<u8'),
+        ('oicao', '<u8'),
+        ('oname', '<u8'),
+        ('ostr', '<u8'),
+        ('strlen', '<u8'),
+        ])
+COL_HDR_SIZE = 128
+
+
+class ColumnarDB:
+    """
+    A memory mapped columnar objects db (refer to store_columnar for the layout).
+    """
+
+    def __init__(self, sFName):
+        self.sFName = sFName
+        self.mm = numpy.memmap(sFName, dtype=numpy.uint8, mode='r')
+        hdr = self.mm[:COL_HDR_DTYPE.itemsize].view(COL_HDR_DTYPE)[0]
+        if hdr['magic'] != COL_MAGIC:
+            raise RuntimeError("ERRR:ODB:{}: Not a columnar odb".format(sFName))
+        self.count = int(hdr['count'])
+        self.nLat = int(hdr['nlat'])
+        self.nLon = int(hdr['nlon'])
+        self.cellDeg = float(hdr['celldeg'])
+        self.lat = self._array(hdr['olat'], '<f8', self.count)
+        self.lon = self._array(hdr['olon'], '<f8', self.count)
+        self.cellStart = self._array(hdr['ocell'], '<u4', self.nLat*self.nLon+1)
+        self.icaoOff = self._array(hdr['oicao'], '<u4', self.count+1)
+        self.nameOff = self._array(hdr['oname'], '<u4', self.count+1)
+        self.strs = self.mm[int(hdr['ostr']):int(hdr['ostr'])+int(hdr['strlen'])]
+
+    def _array(self, iOffset, dtype, iCount):
+        iOffset = int(iOffset)
+        return self.mm[iOffset:iOffset+iCount*numpy.dtype(dtype).itemsize].view(dtype)
+
+    def __len__(self):
+        return self.count
+
+    def _str(self, lOff, i):
+        return self.strs[lOff[i]:lOff[i+1]].tobytes().decode()
+
+    def get_obj(self, i):
+        """
+        Get the i'th object, as a dict (similar to the dict backend's objects).
+        """
+        return { 'icao': self._str(self.icaoOff, i), 'name': self._str(self.nameOff, i),
+                    'lat': float(self.lat[i]), 'lon': float(self.lon[i]) }
+
+    def cells(self, lat, lon):
+        """
+        Map the given lat and lon (numpy arrays or scalars) to their grid cell row and col.
+        """
+        iRow = numpy.clip(numpy.floor((numpy.asarray(lat)+90)/self.cellDeg), 0, self.nLat-1).astype(numpy.int64)
+        iCol = numpy.clip(numpy.floor((numpy.asarray(lon)+180)/self.cellDeg), 0, self.nLon-1).astype(numpy.int64)
+        return iRow, iCol
+
+    def query_bbox_idx(self, latMin, lonMin, latMax, lonMax):
+        """
+        Get the indexes of the objects within the given bounding box (min and max expected in order).
+        Only the grid cells overlapping the box are looked at.
+        """
+        iR0, iC0 = self.cells(latMin, lonMin)
+        iR1, iC1 = self.cells(latMax, lonMax)
+        lIdx = []
+        for iR in range(iR0, iR1+1):
+            iS = self.cellStart[iR*self.nLon+iC0]
+            iE = self.cellStart[iR*self.nLon+iC1+1]
+            if iE > iS:
+                lIdx.append(numpy.arange(iS, iE))
+        if len(lIdx) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        iIdx = numpy.concatenate(lIdx)
+        lat = self.lat[iIdx]
+        lon = self.lon[iIdx]
+        return iIdx[(lat >= latMin) & (lat <= latMax) & (lon >= lonMin) & (lon <= lonMax)]
 
 
 def initdb():
@@ -16,11 +113,64 @@ def store(db, sFName):
 
 
 def load(sFName):
+    """
+    Load the given objects db, which could be either a pickled dict or a columnar db.
+    """
     f = open(sFName, "rb")
+    if f.read(len(COL_MAGIC)) == COL_MAGIC:
+        f.close()
+        return ColumnarDB(sFName)
+    f.seek(0)
     db = pickle.load(f)
     return db
 
 
+def store_columnar(lObjs, sFName, fCellDeg=1.0):
+    """
+    Store the passed list of objects (dicts with lat, lon, icao and optionally name) into a columnar db file.
+    The file contains the header (COL_HDR_DTYPE, padded to COL_HDR_SIZE), followed by
+        the lat and lon float64 arrays,
+        the cellStart uint32 array, where the objects in grid cell c (row major wrt lat, lon)
+            are cellStart[c] to cellStart[c+1]-1,
+        the icao and name offset uint32 arrays into the string table, and the utf8 string table.
+    The objects are stored sorted by their grid cell.
+    """
+    nLat = int(numpy.ceil(180/fCellDeg))
+    nLon = int(numpy.ceil(360/fCellDeg))
+    lat = numpy.array([ float(o['lat']) for o in lObjs ], dtype=numpy.float64)
+    lon = numpy.array([ float(o['lon']) for o in lObjs ], dtype=numpy.float64)
+    iRow = numpy.clip(numpy.floor((lat+90)/fCellDeg), 0, nLat-1).astype(numpy.int64)
+    iCol = numpy.clip(numpy.floor((lon+180)/fCellDeg), 0, nLon-1).astype(numpy.int64)
+    iCell = iRow*nLon + iCol
+    iOrder = numpy.argsort(iCell, kind='stable')
+    cellStart = numpy.zeros(nLat*nLon+1, dtype=numpy.uint32)
+    cellStart[1:] = numpy.cumsum(numpy.bincount(iCell, minlength=nLat*nLon))
+    lStrs = []
+    iOffs = { 'icao': [0], 'name': [0] }
+    iLen = 0
+    for k in [ 'icao', 'name' ]:
+        for i in iOrder:
+            b = str(lObjs[i].get(k, "")).encode()
+            lStrs.append(b)
+            iLen += len(b)
+            iOffs[k].append(iLen)
+    hdr = numpy.zeros(1, dtype=COL_HDR_DTYPE)
+    iPos = COL_HDR_SIZE
+    lArrays = [ lat[iOrder], lon[iOrder], cellStart,
+                numpy.array(iOffs['icao'], dtype=numpy.uint32), numpy.array(iOffs['name'], dtype=numpy.uint32) ]
+    lPos = []
+    for a in lArrays:
+        lPos.append(iPos)
+        iPos += -(-a.nbytes//8)*8
+    hdr[0] = (COL_MAGIC, len(lObjs), nLat, nLon, fCellDeg, lPos[0], lPos[1], lPos[2], lPos[3], lPos[4], iPos, iLen)
+    f = open(sFName, "wb")
+    f.write(hdr.tobytes().ljust(COL_HDR_SIZE, b'\0'))
+    for a in lArrays:
+        f.write(a.astype(a.dtype.newbyteorder('<')).tobytes().ljust(-(-a.nbytes//8)*8, b'\0'))
+    f.write(b''.join(lStrs))
+    f.close()
+
+
 def _key(lat, lon):
     if type(lat) == str:
         lat = float(lat)
@@ -30,15 +180,62 @@ def _key(lat, lon):
 
 
 def set(db, lat, lon, data):
+    if isinstance(db, ColumnarDB):
+        raise RuntimeError("ERRR:ODB:{}: Columnar odb is readonly".format(db.sFName))
     k = _key(lat, lon)
     db[k] = data
 
 
 def get(db, lat, lon):
+    """
+    Get the object at the given lat-lon (at 0.01 degree resolution), or None if there is none.
+    """
     k = _key(lat, lon)
+    if isinstance(db, ColumnarDB):
+        lat, lon = float(lat), float(lon)
+        for i in db.query_bbox_idx(lat-0.01, lon-0.01, lat+0.01, lon+0.01):
+            if _key(db.lat[i], db.lon[i]) == k:
+                return db.get_obj(i)
+        return None
     try:
         return db[k]
     except:
         return None
 
 
+def query_bbox(db, lat0, lon0, lat1, lon1):
+    """
+    Get the list of objects, whose lat and lon fall within the given bounding box.
+    The bounds can be passed in any order.
+    """
+    latMin, latMax = min(lat0, lat1), max(lat0, lat1)
+    lonMin, lonMax = min(lon0, lon1), max(lon0, lon1)
+    if isinstance(db, ColumnarDB):
+        return [ db.get_obj(i) for i in db.query_bbox_idx(latMin, lonMin, latMax, lonMax) ]
+    lObjs = []
+    for obj in db.values():
+        lat = float(obj['lat'])
+        lon = float(obj['lon'])
+        if (lat < latMin) or (lat > latMax):
+            continue
+        if (lon < lonMin) or (lon > lonMax):
+            continue
+        lObjs.append(obj)
+    return lObjs
+
+
+if __name__ == "__main__":
+    # Convert a pickled dict odb into a columnar odb
+    # NOTE: The dict odb keeps only one object per lat-lon key, so the objects which shared a position
+    # (say duplicate entries of an airport) are already lost and wont be in the columnar odb. Use
+    # hkvc-aptdat.py to build the columnar odb from apt.dat, if they are needed.
+    if len(sys.argv) < 3:
+        print("{} <odb.pickle> <odb.odbc> [cellDeg]".format(sys.argv[0]))
+        print("\tNOTE: objects sharing a lat-lon (which the dict odb drops) are not recovered,")
+        print("\t      use hkvc-aptdat.py <apt.dat> to build the columnar odb with them")
+        exit(1)
+    fCellDeg = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    db = load(sys.argv[1])
+    store_columnar(list(db.values()), sys.argv[2], fCellDeg)
+    print("INFO:ODB:Converted:{}:{} objects".format(sys.argv[2], len(db)))
+    print("WARN:ODB:Converted:Objects sharing a lat-lon in the source were already dropped by the dict odb, use hkvc-aptdat.py to keep them")